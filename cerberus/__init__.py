@@ -1,6 +1,19 @@
+import operator
+import threading
+from contextlib import contextmanager
+
 from django.db.models.signals import class_prepared
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
 import django.db.models.options as options
 from django.db.models import Model
+from django.db.models import Q
+from django.db.models import AutoField
+from django.db.models import IntegerField
+from django.db.models import BigIntegerField
+from django.db import connections
+from django.db import transaction
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
@@ -9,8 +22,9 @@ from django.core.urlresolvers import reverse
 options.DEFAULT_NAMES += ('cerberus', 'cerberus_implies', 'cerberus_mutex')
 
 import models
-from views import permissions_view
-from views import permissions_edit
+import shared_cache
+import effective
+import stats
 
 """
 When __init__ is first compiled, we generate a dictionary of Models to 
@@ -39,6 +53,9 @@ class CerberusModelPermission(object):
         self.cls = kwargs.pop('cls')
         self.object_perms = {}
         self.class_perms = {}
+        self.implies = {}
+        self.mutex = []
+        self.parent = None
     def get_object_perm_residence(self, perm):
         pass
     def get_class_perm_residence(self, perm):
@@ -48,25 +65,118 @@ class CerberusModelPermission(object):
 perms_dict = {}
 content_types = {}
 
+# Stands in for the models perms_dict skips, which declare no permissions.
+__no_perms = CerberusModelPermission(cls=None)
+
+def __model_perms(cls):
+    return perms_dict.get(cls, __no_perms)
+
+# Upper bound on the number of values passed to a single IN (...) lookup,
+# keeping bulk queries under database parameter limits (999 on SQLite).
+QUERY_CHUNK_SIZE = 400
+
+# Upper bound on the number of parameters of a single query.
+MAX_QUERY_PARAMS = 999
+
+# Number of group pks a permission query inlines at most, counting each
+# time it repeats them. Users in more groups have their group
+# permissions matched through a membership subquery instead.
+GROUP_PKS_INLINE_LIMIT = 100
+
+# Number of permission rows bulk_set_perm & bulk_remove_perm build and
+# write per transaction.
+BULK_BATCH_SIZE = 10000
+
 def get_class_content_type(cls):
     if cls not in content_types:
         content_types[cls] = ContentType.objects.get_for_model(cls)
+        classes_by_content_type[content_types[cls].pk] = cls
     return content_types[cls] 
 
+classes_by_content_type = {}
+
+def __get_content_type_class(content_type_id):
+    if content_type_id not in classes_by_content_type:
+        classes_by_content_type[content_type_id] = ContentType.objects.get_for_id(
+            content_type_id).model_class()
+    return classes_by_content_type[content_type_id]
+
+"""
+Lookup indexes derived from perms_dict when a model is registered, so
+permission checks and the views never have to walk perms_dict:
+
+instance_perm_classes maps (model, codename) to the class defining the
+permission checked against instances, preferring object perms.
+class_perm_classes does the same for class perms only.
+classes_by_name maps lowercased model names to models for the views.
+granting_perms maps (model, codename) to the codenames granting it: the
+codename itself and, following cerberus_implies transitively, every
+codename implying it.
+exclusive_perms maps (defining class, codename, is_object) to the
+(defining class, codename, is_object) perms cerberus_mutex excludes it
+with, of either kind, as a class perm holds on every object.
+"""
+instance_perm_classes = {}
+class_perm_classes = {}
+classes_by_name = {}
+granting_perms = {}
+exclusive_perms = {}
+
+def __index_model(cls):
+    model_perms = perms_dict[cls]
+    for codename, perm in model_perms.class_perms.items():
+        class_perm_classes[(cls, codename)] = perm.cls
+        instance_perm_classes[(cls, codename)] = perm.cls
+    for codename, perm in model_perms.object_perms.items():
+        instance_perm_classes[(cls, codename)] = perm.cls
+    if hasattr(cls, '_meta') and not cls._meta.abstract:
+        classes_by_name[cls.__name__.lower()] = cls
+    implied_by = {}
+    for codename, implied in model_perms.implies.items():
+        for other in implied:
+            implied_by.setdefault(other, set()).add(codename)
+    for codename in set(model_perms.object_perms) | set(model_perms.class_perms):
+        granting = set([codename])
+        stack = [codename]
+        while stack:
+            for other in implied_by.get(stack.pop(), ()):
+                if other not in granting:
+                    granting.add(other)
+                    stack.append(other)
+        granting_perms[(cls, codename)] = frozenset(granting)
+    for codenames in model_perms.mutex:
+        members = set((perms[c].cls, c, is_object) for (is_object, perms) in (
+            (True, model_perms.object_perms), (False, model_perms.class_perms))
+            for c in codenames if c in perms)
+        for member in members:
+            exclusive_perms.setdefault(member, set()).update(
+                other for other in members if other[1] != member[1])
+
+def __declares_perms(cls):
+    meta = getattr(cls, '_meta', None)
+    return meta is not None and (hasattr(meta, 'cerberus') or
+        hasattr(meta, 'cerberus_implies') or hasattr(meta, 'cerberus_mutex'))
+
 def model_registered(sender, **kwargs):
     """
     Handle model registration as they are
     registered with Django.
+
+    Only models declaring permissions, or inheriting from one which does,
+    are added to perms_dict; every other model of the project costs a
+    dict lookup and a walk of its direct bases.
     """
-    if sender is Model:
+    if sender in perms_dict:
         return
-    for parent in sender.__bases__:
+    bases = [parent for parent in sender.__bases__
+        if parent is not Model and issubclass(parent, Model)]
+    for parent in bases:
         model_registered(parent)
-    if sender not in perms_dict:
+    if __declares_perms(sender) or [parent for parent in bases if parent in perms_dict]:
         perms_dict[sender] = CerberusModelPermission(cls=sender)
         # build inherited objects here
-        for parent in sender.__bases__:
-            if parent is Model:
+        for parent in bases:
+            if parent not in perms_dict:
                 continue
             for p in perms_dict[parent].object_perms.keys():
                 perms_dict[sender].object_perms[p] = perms_dict[parent].object_perms[p]
@@ -75,36 +185,58 @@ def model_registered(sender, **kwargs):
             for p in perms_dict[parent].class_perms.keys():
                 perms_dict[sender].class_perms[p] = perms_dict[parent].class_perms[p]
                 if not sender._meta.abstract and perms_dict[sender].class_perms[p].abstract:
-                    perms_dict[sender].class_perms[p] = perms_dict[sender].object_perms[p].clone_non_abstract(sender)
+                    perms_dict[sender].class_perms[p] = perms_dict[sender].class_perms[p].clone_non_abstract(sender)
+            for p, implied in perms_dict[parent].implies.items():
+                perms_dict[sender].implies.setdefault(p, set()).update(implied)
+            perms_dict[sender].mutex.extend(perms_dict[parent].mutex)
+            perms_dict[sender].parent = perms_dict[sender].parent or perms_dict[parent].parent
         # build this model's dictionary here
         if hasattr(sender, '_meta') and hasattr(sender._meta, 'cerberus'):
+            if 'parent' in sender._meta.cerberus:
+                perms_dict[sender].parent = sender._meta.cerberus['parent']
             if 'object' in sender._meta.cerberus:
                 for p in sender._meta.cerberus['object']:
                     perms_dict[sender].object_perms[p[0]] = CerberusPermission(
                         cls=sender, codename=p[0],
                         text=p[1], description=p[2])
-                if hasattr(sender._meta, 'abstract') and sender._meta.abstract:
-                    perms_dict[sender].object_perms[p[0]].abstract = True
+                    if hasattr(sender._meta, 'abstract') and sender._meta.abstract:
+                        perms_dict[sender].object_perms[p[0]].abstract = True
             if 'class' in sender._meta.cerberus:
                 for p in sender._meta.cerberus['class']:
                     perms_dict[sender].class_perms[p[0]] = CerberusPermission(
                         cls=sender, codename=p[0],
                         text=p[1], description=p[2])
-                if hasattr(sender._meta, 'abstract') and sender._meta.abstract:
-                    perms_dict[sender].class_perms[p[0]].abstract = True
+                    if hasattr(sender._meta, 'abstract') and sender._meta.abstract:
+                        perms_dict[sender].class_perms[p[0]].abstract = True
+        if hasattr(sender, '_meta') and hasattr(sender._meta, 'cerberus_implies'):
+            for p, implied in sender._meta.cerberus_implies.items():
+                perms_dict[sender].implies.setdefault(p, set()).update(implied)
+        if hasattr(sender, '_meta') and hasattr(sender._meta, 'cerberus_mutex'):
+            for codenames in sender._meta.cerberus_mutex:
+                perms_dict[sender].mutex.append(frozenset(codenames))
+        __index_model(sender)
 
 class_prepared.connect(model_registered)
 
 def get_classes():
+    """
+    Returns the models declaring or inheriting permissions.
+    """
     return perms_dict.keys()
 
+def get_class_by_name(clsname):
+    """
+    Returns the model registered under the lowercased clsname, or None.
+    """
+    return classes_by_name.get(clsname)
+
 def get_class_perms(cls):
     """
     Returns all class perms defined on the provided class.
     """
     if not issubclass(cls, Model):
         raise Exception("get_class_perms must take a subclass of Model as first arg")
-    return perms_dict[cls].class_perms
+    return __model_perms(cls).class_perms
 
 def get_object_perms(cls):
     """
@@ -112,7 +244,46 @@ def get_object_perms(cls):
     """
     if not issubclass(cls, Model):
         raise Exception("get_object_perms must take a subclass of Model")
-    return perms_dict[cls].object_perms
+    return __model_perms(cls).object_perms
+
+"""
+ancestor_paths maps models to the (lookup path, ancestor model) pairs of
+the objects above them, nearest first, following the ForeignKey named by
+'parent' in each model's cerberus Meta dict. A parent of the same model,
+e.g. nested folders, is followed CERBERUS_MAX_ANCESTORS levels deep. Paths
+are computed on first use, when lazy relations have been resolved.
+"""
+ancestor_paths = {}
+
+def get_ancestor_paths(cls):
+    if cls not in ancestor_paths:
+        paths = []
+        (path, current) = ([], cls)
+        max_depth = getattr(settings, 'CERBERUS_MAX_ANCESTORS', 10)
+        while __model_perms(current).parent and len(paths) < max_depth:
+            field = current._meta.get_field(__model_perms(current).parent)
+            path.append(field.name)
+            current = field.rel.to
+            paths.append(('__'.join(path), current))
+        ancestor_paths[cls] = paths
+    return ancestor_paths[cls]
+
+def __get_instance_perm_content_type(cls, perm):
+    return get_class_content_type(instance_perm_classes[(cls, perm)])
+
+def __get_grants(cls, perm, index):
+    """
+    Returns (content_type, codenames) pairs for every codename which
+    grants perm on cls, grouped by the content type they are stored
+    under. index is instance_perm_classes or class_perm_classes.
+    """
+    grants = {}
+    for codename in granting_perms.get((cls, perm), (perm,)):
+        if codename != perm and (cls, codename) not in index:
+            continue
+        content_type = get_class_content_type(index[(cls, codename)])
+        grants.setdefault(content_type, set()).add(codename)
+    return grants.items()
 
 def get_perm_content_type(obj, perm):
     """
@@ -126,18 +297,9 @@ def get_perm_content_type(obj, perm):
     'pet', you can do it in very few queries.
     """
     if isinstance(obj, Model):
-        cls = None
-        # try and get the content type via object perms
-        # if not via object perms it should be on a class
-        try:
-            cls = perms_dict[obj.__class__].object_perms[perm].cls
-        except KeyError:
-            cls = perms_dict[obj.__class__].class_perms[perm].cls
-        return get_class_content_type(cls)
+        return __get_instance_perm_content_type(obj.__class__, perm)
     elif issubclass(obj, Model):
-        return ContentType.objects.get_for_model(
-                perms_dict[obj].class_perms[perm].cls
-            )
+        return get_class_content_type(class_perm_classes[(obj, perm)])
     return None
 
 def get_permission_types(obj):
@@ -157,127 +319,1059 @@ def get_permission_types(obj):
         perm_dicts.append({'name': p[0], 'display': p[1], 'description': p[2]})
     return perm_dicts
 
+"""
+Permission checks are cached on the User instance, much like Django's
+own _perm_cache. Every permission or group membership write bumps a
+generation counter so caches built before the write are thrown away.
+When CERBERUS_CACHE is set, class permissions and group memberships are
+also shared between processes, see shared_cache.
+"""
+
+_cache_generation = [0]
+
+def invalidate_perm_cache(principal=None):
+    """
+    Marks every per-user permission cache as stale, along with the
+    shared cache entries of the provided User or Group.
+    """
+    _cache_generation[0] += 1
+    if isinstance(principal, User):
+        shared_cache.bump_version('user', principal.pk)
+    elif isinstance(principal, Group):
+        shared_cache.bump_version('group', principal.pk)
+
+def __group_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+        return
+    _cache_generation[0] += 1
+    if not reverse:
+        shared_cache.bump_version('user', instance.pk)
+        return
+    if action == 'pre_clear':
+        # bumped again once the rows are gone, so that the old memberships
+        # are not cached in between
+        pk_set = instance._cerberus_cleared_users = list(
+            instance.user_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cerberus_cleared_users', ())
+    for pk in pk_set:
+        shared_cache.bump_version('user', pk)
+
+m2m_changed.connect(__group_membership_changed, sender=User.groups.through)
+
+def __group_deleted(sender, instance, **kwargs):
+    # memberships are removed without an m2m_changed signal
+    invalidate_perm_cache(instance)
+
+post_delete.connect(__group_deleted, sender=Group)
+
+@contextmanager
+def _write_transaction(using):
+    """
+    Runs the block in a transaction committed when it completes, unless
+    the caller already manages one: Django has no nested transactions,
+    so committing here would commit the caller's work along with it.
+    """
+    if transaction.is_managed(using=using):
+        yield
+    else:
+        with transaction.commit_on_success(using=using):
+            yield
+
+"""
+Object permission rows point at their objects through a generic relation,
+which does not cascade, so they are deleted along with the objects here.
+"""
+# the deferred_perm_cleanup blocks open in each thread
+_deferred_cleanup = threading.local()
+
+def __deferred_blocks():
+    if not hasattr(_deferred_cleanup, 'blocks'):
+        _deferred_cleanup.blocks = []
+    return _deferred_cleanup.blocks
+
+def _delete_object_perms(content_type_pks, object_pks):
+    """
+    Deletes the object permission rows, and effective rows, stored under
+    content_type_pks for the objects, QUERY_CHUNK_SIZE pks at a time.
+    """
+    perm_models = [models.UserObjectPermission, models.GroupObjectPermission]
+    if effective.enabled():
+        perm_models.append(models.EffectivePermission)
+    # the effective rows are deleted directly instead of re-synced per row
+    with effective.suspended():
+        for chunk in _chunks(object_pks):
+            for model in perm_models:
+                model.objects.filter(content_type__in=content_type_pks,
+                    object_pk__in=chunk).delete()
+    invalidate_perm_cache()
+
+def __object_deleted(sender, instance, **kwargs):
+    # class permissions do not reference the instance
+    if not __model_perms(sender).object_perms:
+        return
+    content_type_pks = frozenset(__perm_content_type_pks(sender, instance_perm_classes))
+    blocks = __deferred_blocks()
+    if blocks:
+        blocks[-1].setdefault(content_type_pks, []).append(instance.pk)
+    else:
+        _delete_object_perms(content_type_pks, [instance.pk])
+
+post_delete.connect(__object_deleted)
+
+@contextmanager
+def deferred_perm_cleanup():
+    """
+    Collects the objects deleted inside the block, e.g. by a queryset
+    delete, and deletes their permission rows with one query per table
+    and chunk of QUERY_CHUNK_SIZE objects once it completes, rather than
+    with queries for every object. Objects deleted before an exception
+    in the block are cleaned up as well.
+    """
+    blocks = __deferred_blocks()
+    blocks.append({})
+    try:
+        yield
+    finally:
+        deleted = blocks.pop()
+        for content_type_pks, object_pks in deleted.items():
+            _delete_object_perms(content_type_pks, object_pks)
+
+class PermissionConflict(Exception):
+    """
+    Raised when a grant or group membership would make a User or Group
+    hold permissions which cerberus_mutex declares mutually exclusive.
+    conflicts holds the (granted_row, held_row) pairs from
+    _exclusive_conflicts.
+    """
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        (row, held) = conflicts[0]
+        Exception.__init__(self, "'%s' can not be held together with '%s' (%d conflicts)" % (
+            row[-1], held[-1], len(conflicts)))
+
 def set_perm(self, permission, obj_or_cls):
     content_type = get_perm_content_type(obj_or_cls, permission)
-    if isinstance(obj_or_cls, Model):
-        if isinstance(self, User):
-            pmo = models.UserObjectPermission(user=self, codename=permission, content_type=content_type, object_pk=obj_or_cls.pk)
-        elif isinstance(self, Group):
-            pmo = models.GroupObjectPermission(group=self, codename=permission, content_type=content_type, object_pk=obj_or_cls.pk)
+    if isinstance(self, (User, Group)):
+        is_object = isinstance(obj_or_cls, Model)
+        conflicts = _exclusive_conflicts(isinstance(self, User) and 'user' or 'group', is_object,
+            [(self.pk, content_type.pk, obj_or_cls.pk if is_object else None, permission)])
+        if conflicts:
+            raise PermissionConflict(conflicts)
+    # versions are bumped before and after the write, so that inside a
+    # transaction managed by the caller the old permissions are not
+    # cached under the new version by this process
+    invalidate_perm_cache(self)
+    with _write_transaction(models.UserObjectPermission.objects.db):
+        if isinstance(obj_or_cls, Model):
+            if isinstance(self, User):
+                (pmo, created) = models.UserObjectPermission.objects.get_or_create(user=self, codename=permission, content_type=content_type, object_pk=obj_or_cls.pk)
+            elif isinstance(self, Group):
+                (pmo, created) = models.GroupObjectPermission.objects.get_or_create(group=self, codename=permission, content_type=content_type, object_pk=obj_or_cls.pk)
+            else:
+                raise ValueError("First argument must be User or Group object.")
+        elif issubclass(obj_or_cls, Model):
+            if isinstance(self, User):
+                (pmo, created) = models.UserClassPermission.objects.get_or_create(user=self, codename=permission, content_type=content_type)
+            elif isinstance(self, Group):
+                (pmo, created) = models.GroupClassPermission.objects.get_or_create(group=self, codename=permission, content_type=content_type)
+            else:
+                raise ValueError("First argument must be a User or Group object.")
         else:
-            raise ValueError("First argument must be User or Group object.")
-    elif issubclass(obj_or_cls, Model):
-        if isinstance(self, User):
-            pmo = models.UserClassPermission(user=self, codename=permission, content_type=content_type)
-        elif isinstance(self, Group):
-            pmo = models.GroupClassPermission(group=self, codename=permission, content_type=content_type)
-        else:
-            raise ValueError("First argument must be a User or Group object.")
-    else:
-        raise ValueError("Set permission must take a model class or instance as second argument")
-    pmo.save()
+            raise ValueError("Set permission must take a model class or instance as second argument")
+    if created:
+        invalidate_perm_cache(self)
     return True
 
 def _remove_perm(self, permission, obj_or_cls):
-    if isinstance(obj_or_cls, Model):
-        content_type = ContentType.objects.get_for_model(obj_or_cls.__class__)
-        if isinstance(self, User):
-            pmo = models.UserObjectPermission.objects.get(user=self, codename=permission, content_type=content_type, object_pk=obj_or_cls.pk)
-        elif isinstance(self, Group):
-            pmo = models.GroupObjectPermission.objects.get(group=self, codename=permission, content_type=content_type, object_pk=obj_or_cls.pk)
+    content_type = get_perm_content_type(obj_or_cls, permission)
+    invalidate_perm_cache(self)
+    with _write_transaction(models.UserObjectPermission.objects.db):
+        if isinstance(obj_or_cls, Model):
+            if isinstance(self, User):
+                pmo = models.UserObjectPermission.objects.get(user=self, codename=permission, content_type=content_type, object_pk=obj_or_cls.pk)
+            elif isinstance(self, Group):
+                pmo = models.GroupObjectPermission.objects.get(group=self, codename=permission, content_type=content_type, object_pk=obj_or_cls.pk)
+            else:
+                raise ValueError("First argument must be a User or Group object.")
+        elif issubclass(obj_or_cls, Model):
+            if isinstance(self, User):
+                pmo = models.UserClassPermission.objects.get(user=self, codename=permission, content_type=content_type)
+            elif isinstance(self, Group):
+                pmo = models.GroupClassPermission.objects.get(group=self, codename=permission, content_type=content_type)
+            else:
+                raise ValueError("First argument must be a User or Group object.")
         else:
-            raise ValueError("First argument must be a User or Group object.")
-    elif issubclass(obj_or_cls, Model):
-        content_type = ContentType.objects.get_for_model(obj_or_cls)
-        if isinstance(self, User):
-            pmo = models.UserClassPermission.objects.get(user=self, codename=permission, content_type=content_type)
-        elif isinstance(self, Group):
-            pmo = models.GroupClassPermission.objects.get(group=self, codename=permission, content_type=content_type)
+            raise ValueError("Remove permission must take a model class or instance as second argument")
+        pmo.delete()
+    invalidate_perm_cache(self)
+    return True
+
+def __perm_model(principal_field, is_object):
+    if principal_field == 'user':
+        return is_object and models.UserObjectPermission or models.UserClassPermission
+    return is_object and models.GroupObjectPermission or models.GroupClassPermission
+
+def __row_fields(principal_field, is_object):
+    if is_object:
+        return [principal_field, 'content_type', 'object_pk', 'codename']
+    return [principal_field, 'content_type', 'codename']
+
+def __perm_rows(is_object, rows):
+    """
+    Returns rows, as read with __row_fields, as a set of (principal_pk,
+    content_type_id, object_pk, codename) tuples with object_pk in its
+    stored form, or None for class permissions.
+    """
+    if is_object:
+        return set((row[0], row[1], models.object_pk_value(row[2]), row[-1]) for row in rows)
+    return set((row[0], row[1], None, row[-1]) for row in rows)
+
+def __lookup_batches(principal_field, rows):
+    """
+    Turns (principal_pk, content_type_id, object_pk, codename) rows into
+    OR-ed Q objects matching them, batched so that no query passes more
+    than QUERY_CHUNK_SIZE values. Object pks are folded into
+    object_pk__in lookups.
+    """
+    grouped = {}
+    for (principal_pk, content_type_id, object_pk, codename) in rows:
+        object_pks = grouped.setdefault((principal_pk, content_type_id, codename), set())
+        if object_pk is not None:
+            object_pks.add(object_pk)
+    batch = []
+    size = 0
+    for (principal_pk, content_type_id, codename), object_pks in grouped.items():
+        lookup = {principal_field: principal_pk, 'content_type': content_type_id,
+            'codename': codename}
+        if object_pks:
+            lookups = [(Q(object_pk__in=chunk, **lookup), 3 + len(chunk))
+                for chunk in _chunks(object_pks)]
+        else:
+            lookups = [(Q(**lookup), 3)]
+        for (q, q_size) in lookups:
+            if batch and size + q_size > QUERY_CHUNK_SIZE:
+                yield reduce(operator.or_, batch)
+                batch = []
+                size = 0
+            batch.append(q)
+            size += q_size
+    if batch:
+        yield reduce(operator.or_, batch)
+
+"""
+Paths from each permission table to the principal of a grant holding its
+rows: a user holds their own permissions and those of their groups, a
+group's grant is held by the group and by each of its members, along
+with their own permissions and those of all their groups.
+"""
+__holder_paths = {
+    'user': (('user', 'user'), ('group', 'group__user')),
+    'group': (('group', 'group'), ('user', 'user__groups'), ('group', 'group__user__groups')),
+}
+
+# Stands in for the object_pk of perms excluded on every object.
+__any_object = object()
+
+def __excluded_perms(row):
+    """
+    Returns the (content_type_id, object_pk, codename) perms cerberus_mutex
+    excludes the row with. object_pk is None for class perms, and
+    __any_object for object perms excluded by a class perm.
+    """
+    (principal_pk, content_type_pk, object_pk, codename) = row
+    is_object = object_pk is not None
+    excluded = []
+    for (cls, other, other_is_object) in exclusive_perms.get(
+            (__get_content_type_class(content_type_pk), codename, is_object), ()):
+        if not other_is_object:
+            other_pk = None
+        elif is_object:
+            other_pk = object_pk
+        else:
+            other_pk = __any_object
+        excluded.append((get_class_content_type(cls).pk, other_pk, other))
+    return excluded
+
+def _exclusive_conflicts(principal_field, is_object, grants, revokes=()):
+    """
+    Returns (granted_row, held_row) pairs for every grant which would be
+    held along with a permission cerberus_mutex excludes it with, on the
+    same object or through a class permission.
+
+    Grants are (principal_pk, content_type_id, object_pk, codename) rows,
+    held rows the (principal_field, principal_pk, ...) row found. Held
+    rows are looked up among the grants and in every table a grant's
+    holders hold permissions through, see __holder_paths, leaving out
+    rows about to be revoked. Grants of codenames without cerberus_mutex
+    never reach the database.
+    """
+    if not exclusive_perms:
+        return []
+    revoked = set((principal_field, ) + row for row in __perm_rows(is_object, revokes))
+    return __held_conflicts(principal_field, __perm_rows(is_object, grants), revoked)
+
+def __held_conflicts(principal_field, grants, revoked=()):
+    wanted = {}
+    for row in grants:
+        for perm in __excluded_perms(row):
+            wanted.setdefault((row[0], ) + perm, []).append(row)
+    if not wanted:
+        return []
+    found = set()
+    # the grants are held along with each other
+    for row in grants:
+        for key in (row, (row[0], row[1], __any_object, row[3])):
+            if key in wanted:
+                found.add((key, (principal_field, ) + row))
+    lookups = {}
+    for key in wanted:
+        if key[2] is __any_object:
+            lookups.setdefault((True, True), []).append((key[0], key[1], None, key[3]))
         else:
-            raise ValueError("First argument must be a User or Group object.")
+            lookups.setdefault((key[2] is not None, False), []).append(key)
+    for (table_field, path) in __holder_paths[principal_field]:
+        for (is_object, any_object), rows in lookups.items():
+            model = __perm_model(table_field, is_object)
+            fields = [path] + __row_fields(table_field, is_object)
+            for q in __lookup_batches(path, rows):
+                for values in model.objects.filter(q).values_list(*fields):
+                    object_pk = is_object and models.object_pk_value(values[3]) or None
+                    held = (table_field, values[1], values[2], object_pk, values[-1])
+                    key = (values[0], values[2], any_object and __any_object or object_pk,
+                        values[-1])
+                    if key in wanted and held not in revoked:
+                        found.add((key, held))
+    return [(row, held) for (key, held) in found for row in wanted[key]]
+
+def __membership_conflicts(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Refuses group memberships which would make a user hold permissions
+    cerberus_mutex declares mutually exclusive, checking the groups'
+    rows as grants to the user.
+    """
+    if action != 'pre_add' or not exclusive_perms or not pk_set:
+        return
+    if reverse:
+        memberships = [(user_pk, instance.pk) for user_pk in pk_set]
     else:
-        raise ValueError("Remove permission must take a model class or instance as second argument")
-    pmo.delete()
-    return True
+        memberships = [(instance.pk, group_pk) for group_pk in pk_set]
+    codenames = set(codename for (cls, codename, is_object) in exclusive_perms)
+    group_perms = {}
+    for is_object in (True, False):
+        for row in __perm_rows(is_object, __perm_model('group', is_object).objects.filter(
+                group__in=set(group_pk for (user_pk, group_pk) in memberships),
+                codename__in=codenames).values_list(*__row_fields('group', is_object))):
+            group_perms.setdefault(row[0], []).append(row[1:])
+    conflicts = __held_conflicts('user', set((user_pk, ) + perm
+        for (user_pk, group_pk) in memberships for perm in group_perms.get(group_pk, ())))
+    if conflicts:
+        raise PermissionConflict(conflicts)
 
-def __extract_codenames(values):
-    codenames = set()
-    for obj in values:
-        codenames.add(obj['codename'])
-    return codenames
+m2m_changed.connect(__membership_conflicts, sender=User.groups.through)
 
-def __user_has_obj_permission(content_type, object_pk, user, perm):
-    # first check direct user perms
-    if models.UserObjectPermission.objects.filter(content_type=content_type,
-            object_pk=object_pk, user=user, codename=perm).exists():
-        return True
-    # check if users groups pass for true
-    if models.GroupObjectPermission.objects.filter(content_type=content_type,
-            object_pk=object_pk, group__in=user.groups.all(), codename=perm).exists():
-        return True
-    # check if class perm sets it
-    if models.UserClassPermission.objects.filter(content_type=content_type,
-            user=user, codename=perm).exists():
-        return True
-    if models.GroupClassPermission.objects.filter(content_type=content_type,
-            group__in=user.groups.all(), codename=perm).exists():
-        return True
+def _bulk_insert(model, objs):
+    """
+    Inserts objs with bulk_create where the Django version provides it,
+    and otherwise with one executemany INSERT per QUERY_CHUNK_SIZE
+    objects rather than a save() per row. Either way no signals are
+    sent and primary keys are not set on objs.
+    """
+    if hasattr(model.objects, 'bulk_create'):
+        for chunk in _chunks(objs):
+            model.objects.bulk_create(chunk)
+        return
+    using = model.objects.db
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [field for field in model._meta.local_fields if not isinstance(field, AutoField)]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table),
+        ', '.join([qn(field.column) for field in fields]), ', '.join(['%s'] * len(fields)))
+    cursor = connection.cursor()
+    for chunk in _chunks(objs):
+        cursor.executemany(sql, [[field.get_db_prep_save(field.pre_save(obj, True),
+            connection=connection) for field in fields] for obj in chunk])
+    transaction.commit_unless_managed(using=using)
+
+def _bulk_write_perms(principal_field, is_object, grants=(), revokes=()):
+    """
+    Grants and revokes many permissions inside one transaction.
+
+    principal_field is 'user' or 'group'. grants and revokes are
+    iterables of (principal_pk, content_type_id, object_pk, codename)
+    tuples, with object_pk None for class permissions. Rows which
+    already exist are skipped, found with one query per batch, and
+    revoked rows are deleted with one filtered delete per batch.
+    """
+    _bulk_write_many([(principal_field, is_object, grants, revokes)])
+
+def _bulk_write_many(writes):
+    """
+    Applies (principal_field, is_object, grants, revokes) writes, as
+    taken by _bulk_write_perms, inside a single transaction: if any of
+    them fails none is committed. Inside a transaction managed by the
+    caller, the writes join it and are left for the caller to commit.
+    """
+    writes = [(principal_field, is_object, __perm_rows(is_object, grants),
+        __perm_rows(is_object, revokes))
+        for (principal_field, is_object, grants, revokes) in writes]
+    principals = set((principal_field, row[0])
+        for (principal_field, is_object, grants, revokes) in writes
+        for row in grants | revokes)
+    # bumped before and after, as in set_perm
+    __bump_versions(principals)
+    with _write_transaction(models.UserObjectPermission.objects.db), effective.suspended():
+        for write in writes:
+            __write_perms(*write)
+    __bump_versions(principals)
+
+def __bump_versions(principals):
+    invalidate_perm_cache()
+    for (principal_field, principal_pk) in principals:
+        shared_cache.bump_version(principal_field, principal_pk)
+
+def __write_perms(principal_field, is_object, grants, revokes):
+    model = __perm_model(principal_field, is_object)
+    fields = __row_fields(principal_field, is_object)
+    for q in __lookup_batches(principal_field, revokes):
+        model.objects.filter(q).delete()
+    existing = set()
+    for q in __lookup_batches(principal_field, grants):
+        existing.update(__perm_rows(is_object, model.objects.filter(q).values_list(*fields)))
+    conflicts = _exclusive_conflicts(principal_field, is_object, grants - existing)
+    if conflicts:
+        raise PermissionConflict(conflicts)
+    objs = []
+    for row in grants - existing:
+        kwargs = {principal_field + '_id': row[0], 'content_type_id': row[1],
+            'codename': row[3]}
+        if is_object:
+            kwargs['object_pk'] = row[2]
+        objs.append(model(**kwargs))
+    _bulk_insert(model, objs)
+    if effective.enabled() and (grants or revokes):
+        principal_pks = set(row[0] for row in grants | revokes)
+        if principal_field == 'group':
+            principal_pks = User.groups.through.objects.filter(
+                group__in=principal_pks).values_list('user', flat=True).distinct()
+        effective.sync(list(principal_pks), objects=is_object, classes=not is_object,
+            content_type__in=set(row[1] for row in grants | revokes),
+            codename__in=set(row[3] for row in grants | revokes))
+
+def __bulk_perms(principals, codenames, objs_or_clses, grant):
+    by_kind = {'user': [], 'group': []}
+    for principal in principals:
+        if isinstance(principal, User):
+            by_kind['user'].append(principal.pk)
+        elif isinstance(principal, Group):
+            by_kind['group'].append(principal.pk)
+        else:
+            raise ValueError("Principals must be User or Group objects.")
+    targets = {True: [], False: []}
+    for obj_or_cls in objs_or_clses:
+        if isinstance(obj_or_cls, Model):
+            targets[True].append(obj_or_cls)
+        elif isinstance(obj_or_cls, type) and issubclass(obj_or_cls, Model):
+            targets[False].append(obj_or_cls)
+        else:
+            raise ValueError("Permissions must be set on model classes or instances.")
+    for is_object, objs in targets.items():
+        # resolve content types once, not once per principal
+        lookups = [(get_perm_content_type(obj_or_cls, codename).pk,
+            obj_or_cls.pk if is_object else None, codename)
+            for obj_or_cls in objs for codename in codenames]
+        if not lookups:
+            continue
+        batch_size = max(1, BULK_BATCH_SIZE // len(lookups))
+        for principal_field, pks in by_kind.items():
+            for chunk in _chunks(pks, batch_size):
+                rows = [(pk, ) + lookup for pk in chunk for lookup in lookups]
+                if grant:
+                    _bulk_write_perms(principal_field, is_object, grants=rows)
+                else:
+                    _bulk_write_perms(principal_field, is_object, revokes=rows)
+
+def bulk_set_perm(principals, codenames, objs_or_clses):
+    """
+    Grants every codename to every User or Group in principals on every
+    model instance or class in objs_or_clses.
+
+    The rows are written in transactions of about BULK_BATCH_SIZE rows,
+    rows which already exist are skipped.
+    """
+    __bulk_perms(principals, codenames, objs_or_clses, True)
+
+def bulk_remove_perm(principals, codenames, objs_or_clses):
+    """
+    Revokes every codename from every User or Group in principals on
+    every model instance or class in objs_or_clses.
+    """
+    __bulk_perms(principals, codenames, objs_or_clses, False)
+
+def __compile(qs, *fields):
+    if fields:
+        qs = qs.values_list(*fields)
+    return qs.query.get_compiler(using=qs.db).as_sql()
+
+def __exists_any(querysets):
+    """
+    Returns True if any of the provided querysets matches a row.
+
+    All querysets are folded into a single EXISTS ... OR EXISTS ...
+    statement so the check costs one round-trip to the database no
+    matter how many permission tables are involved.
+    """
+    clauses = []
+    params = []
+    for qs in querysets:
+        sql, qs_params = __compile(qs, 'id')
+        clauses.append('EXISTS (%s)' % sql)
+        params.extend(qs_params)
+    stats.count('queries')
+    cursor = connections[querysets[0].db].cursor()
+    cursor.execute('SELECT CASE WHEN %s THEN 1 ELSE 0 END' % ' OR '.join(clauses), params)
+    return bool(cursor.fetchone()[0])
+
+def __union_values_list(querysets, *fields):
+    """
+    Returns the distinct rows of values_list(*fields) across all
+    provided querysets, fetched with a single UNION query. Without
+    fields the querysets are expected to be values_list querysets
+    selecting matching columns.
+    """
+    parts = []
+    params = []
+    for qs in querysets:
+        sql, qs_params = __compile(qs, *fields)
+        parts.append(sql)
+        params.extend(qs_params)
+    stats.count('queries')
+    cursor = connections[querysets[0].db].cursor()
+    cursor.execute(' UNION '.join(parts), params)
+    return cursor.fetchall()
+
+def __class_perm_sets(rows):
+    class_perms = {}
+    for (content_type_id, codename) in rows:
+        class_perms.setdefault(content_type_id, set()).add(codename)
+    return class_perms
+
+def __get_shared_class_perms(shared, user):
+    """
+    Returns the user's class perms, merged with those of their groups,
+    and the pks of their groups from the shared cache. Only the user and groups whose entries are
+    missing are loaded from the database.
+    """
+    versions = shared_cache.get_versions(shared, 'user', [user.pk])
+    entry = shared_cache.get_entries(shared, 'user', versions).get(user.pk)
+    if entry is None:
+        stats.count('cache_misses')
+        stats.count('queries', 2)
+        entry = {
+            'groups': tuple(user.groups.values_list('pk', flat=True)),
+            'class_perms': __class_perm_sets(models.UserClassPermission.objects.filter(
+                user=user).values_list('content_type', 'codename')),
+        }
+        shared_cache.set_entries(shared, 'user', versions, {user.pk: entry})
+    else:
+        stats.count('cache_hits')
+    group_versions = shared_cache.get_versions(shared, 'group', entry['groups'])
+    group_entries = shared_cache.get_entries(shared, 'group', group_versions)
+    missing = [pk for pk in entry['groups'] if pk not in group_entries]
+    stats.count('cache_hits', len(group_entries))
+    if missing:
+        stats.count('cache_misses', len(missing))
+        stats.count('queries')
+        rows = {}
+        for (group_id, content_type_id, codename) in models.GroupClassPermission.objects.filter(
+                group__in=missing).values_list('group', 'content_type', 'codename'):
+            rows.setdefault(group_id, []).append((content_type_id, codename))
+        loaded = dict((pk, __class_perm_sets(rows.get(pk, ()))) for pk in missing)
+        shared_cache.set_entries(shared, 'group', group_versions, loaded)
+        group_entries.update(loaded)
+    class_perms = {}
+    for perm_sets in [entry['class_perms']] + group_entries.values():
+        for content_type_id, codenames in perm_sets.items():
+            class_perms.setdefault(content_type_id, set()).update(codenames)
+    return (class_perms, entry['groups'])
+
+def __get_class_perms_and_groups(user):
+    """
+    Returns the user's class perms, merged with those of their groups,
+    and the pks of their groups, read with a single UNION query.
+    """
+    rows = __union_values_list([
+        models.UserClassPermission.objects.filter(user=user).extra(
+            select={'is_group': '0'}).values_list('is_group', 'user', 'content_type', 'codename'),
+        # the outer join keeps groups which hold no class perms
+        User.groups.through.objects.filter(user=user).extra(
+            select={'is_group': '1'}).values_list('is_group', 'group',
+            'group__groupclasspermission__content_type', 'group__groupclasspermission__codename'),
+    ])
+    group_pks = set(row[1] for row in rows if row[0])
+    class_perms = __class_perm_sets(row[2:] for row in rows if row[2] is not None)
+    return (class_perms, tuple(sorted(group_pks)))
+
+def __fresh_perm_cache(user):
+    cache = getattr(user, '_cerberus_perm_cache', None)
+    if cache is not None and cache['generation'] == _cache_generation[0]:
+        return cache
+    return None
+
+def __get_perm_cache(user):
+    """
+    Returns the permission cache stored on the user, (re)building it
+    when missing or stale. Building loads every class permission the
+    user holds, directly or through groups, and the pks of the user's
+    groups in one query.
+    """
+    cache = __fresh_perm_cache(user)
+    if cache is not None:
+        stats.count('cache_hits')
+        return cache
+    stats.count('cache_misses')
+    cache = {
+        'generation': _cache_generation[0],
+        'class_perms': {},
+        'object_perms': {},
+        'group_pks': None,
+    }
+    shared = shared_cache.get_shared_cache(models.UserClassPermission.objects.db)
+    if shared is not None:
+        (cache['class_perms'], cache['group_pks']) = __get_shared_class_perms(shared, user)
+    elif effective.enabled():
+        stats.count('queries')
+        cache['class_perms'] = __class_perm_sets(models.EffectivePermission.objects.filter(
+            user=user, object_pk__isnull=True).values_list('content_type', 'codename'))
+    else:
+        (cache['class_perms'], cache['group_pks']) = __get_class_perms_and_groups(user)
+    user._cerberus_perm_cache = cache
+    return cache
+
+def __get_group_pks(user):
+    """
+    Returns the pks of the user's groups as a tuple, memoized in the
+    permission cache so group tables are filtered with group_id__in
+    instead of a membership subquery in every check.
+    """
+    cache = __fresh_perm_cache(user) or __get_perm_cache(user)
+    if cache['group_pks'] is None:
+        # the effective table does not need them to build the cache
+        stats.count('queries')
+        cache['group_pks'] = tuple(user.groups.values_list('pk', flat=True))
+    return cache['group_pks']
+
+def __grants_q(grants):
+    return reduce(operator.or_, [Q(content_type=content_type, codename__in=codenames)
+        for (content_type, codenames) in grants])
+
+def __class_perm_granted(cache, grants):
+    for content_type, codenames in grants:
+        if cache['class_perms'].get(content_type.pk, frozenset()) & codenames:
+            return True
     return False
 
+def __hierarchy_grants(cls, perm):
+    """
+    Returns (path, ancestor, grants) for each ancestor of cls which perm
+    is also registered on, holding it there granting it on cls.
+    """
+    return [(path, ancestor, __get_grants(ancestor, perm, instance_perm_classes))
+        for (path, ancestor) in get_ancestor_paths(cls)
+        if (ancestor, perm) in instance_perm_classes]
+
+def __ancestor_levels(cls, paths, object_pks, instance=None):
+    """
+    Returns a {ancestor_pk: [object_pk, ...]} dict for each of the paths
+    above the objects of cls, read with one query, or none when instance
+    already holds its parent's pk.
+    """
+    levels = [{} for path in paths]
+    if instance is not None and len(paths) == 1 and '__' not in paths[0]:
+        rows = [(instance.pk, getattr(instance, cls._meta.get_field(paths[0]).attname))]
+    else:
+        stats.count('queries')
+        rows = cls._default_manager.filter(pk__in=object_pks).values_list('pk', *paths)
+    for row in rows:
+        object_pk = models.object_pk_value(row[0])
+        for (level, ancestor_pk) in zip(levels, row[1:]):
+            if ancestor_pk is not None:
+                level.setdefault(models.object_pk_value(ancestor_pk), []).append(object_pk)
+    return levels
+
+def __perm_levels(cls, perm, grants, object_pks, instance=None):
+    """
+    Returns the (grants, {object_pk: [object_pk, ...]}) levels perm is
+    looked up on for the objects of cls: the objects themselves, then
+    their ancestors, mapped to the objects beneath them.
+    """
+    object_pks = [models.object_pk_value(object_pk) for object_pk in object_pks]
+    levels = [(grants, dict((object_pk, [object_pk]) for object_pk in object_pks))]
+    hierarchy = __hierarchy_grants(cls, perm)
+    if hierarchy:
+        levels += zip([level_grants for (path, ancestor, level_grants) in hierarchy],
+            __ancestor_levels(cls, [path for (path, ancestor, level_grants) in hierarchy],
+                object_pks, instance))
+    return levels
+
+def __levels_q(levels):
+    return reduce(operator.or_, [__grants_q(grants) & Q(object_pk__in=pks.keys())
+        for (grants, pks) in levels if pks])
+
+def __user_has_obj_permission(levels, user):
+    # direct user and group perms on every level are resolved in one query
+    return __exists_any([qs.filter(__levels_q(levels))
+        for qs in __object_perm_querysets(user)])
+
+@stats.instrumented('has_perm')
 def has_perm(self, perm, obj):
     content_type = get_perm_content_type(obj, perm) 
+    cache = __get_perm_cache(self)
     if isinstance(obj, Model):
-        return __user_has_obj_permission(content_type, obj.pk, self, perm)
-    if models.UserClassPermission.objects.filter(content_type=content_type).filter(user=self).filter(codename=perm).exists():
-        return True
-    if models.GroupClassPermission.objects.filter(content_type=content_type,
-            group__in=self.groups.all(), codename=perm).exists():
+        grants = __get_grants(obj.__class__, perm, instance_perm_classes)
+    else:
+        grants = __get_grants(obj, perm, class_perm_classes)
+    # class perms also satisfy object checks
+    if __class_perm_granted(cache, grants):
         return True
-    return False
+    if not isinstance(obj, Model):
+        return False
+    key = (content_type.pk, models.object_pk_value(obj.pk), perm)
+    if key in cache['object_perms']:
+        stats.count('cache_hits')
+    else:
+        stats.count('cache_misses')
+        cache['object_perms'][key] = __user_has_obj_permission(
+            __perm_levels(obj.__class__, perm, grants, [obj.pk], obj), self)
+    return cache['object_perms'][key]
+
+def __object_pk_subquery(qs, cls):
+    """
+    Returns qs selecting object_pk for an IN lookup against the primary
+    key of cls. Stored as text, object_pks are cast when cls has an
+    integer primary key: PostgreSQL refuses to compare integer and
+    character varying columns.
+    """
+    field = cls._meta.pk
+    while field.rel is not None:
+        # multi-table inheritance, the key is the parent's
+        field = field.rel.get_related_field()
+    if isinstance(qs.model._meta.get_field('object_pk'), IntegerField) or not isinstance(
+            field, (AutoField, IntegerField)):
+        return qs.values('object_pk')
+    connection = connections[qs.db]
+    if connection.vendor == 'mysql':
+        db_type = 'SIGNED'
+    elif isinstance(field, BigIntegerField):
+        db_type = 'BIGINT'
+    else:
+        db_type = 'INTEGER'
+    # left unqualified as the table is aliased once nested in the outer query
+    column = connection.ops.quote_name('object_pk')
+    return qs.extra(select={'object_pk_value': 'CAST(%s AS %s)' % (column, db_type)}).values(
+        'object_pk_value')
+
+@stats.instrumented('objects_with_perm')
+def objects_with_perm(user, perm, queryset):
+    """
+    Returns queryset filtered down to the objects the user holds perm on.
+
+    The result is still a lazy QuerySet: object permissions are joined in
+    as subqueries on object_pk, so listing every Animal a user can 'pet'
+    costs a single query. Permissions held on ancestors are matched
+    through their lookup paths in that same query. If the user holds perm
+    as a class permission the queryset is returned unfiltered.
+    """
+    if not user.is_authenticated():
+        return queryset.none()
+    if user.is_superuser:
+        return queryset
+    grants = __get_grants(queryset.model, perm, instance_perm_classes)
+    if __class_perm_granted(__get_perm_cache(user), grants):
+        return queryset
+    levels = [('pk', queryset.model, grants)] + __hierarchy_grants(queryset.model, perm)
+    return queryset.filter(reduce(operator.or_, [
+        Q(**{path + '__in': __object_pk_subquery(qs.filter(__grants_q(level_grants)), model)})
+        for (path, model, level_grants) in levels
+        for qs in __object_perm_querysets(user, repeat=len(levels))]))
+
+def _chunks(values, size=None):
+    values = list(values)
+    size = size or QUERY_CHUNK_SIZE
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+@stats.instrumented('has_perms_many')
+def has_perms_many(user, perm, objs):
+    """
+    Checks perm against many objects at once, returning a dict mapping
+    each object's pk to a bool.
+
+    Object permissions are fetched with object_pk__in lookups in chunks
+    of QUERY_CHUNK_SIZE values, along with those of the objects'
+    ancestors, so the number of queries does not grow with each object.
+    Answers are also stored in the user's permission cache.
+    """
+    objs = list(objs)
+    if not user.is_authenticated():
+        return dict((obj.pk, False) for obj in objs)
+    if user.is_superuser:
+        return dict((obj.pk, True) for obj in objs)
+    cache = __get_perm_cache(user)
+    response = {}
+    pending = {}
+    for obj in objs:
+        grants = __get_grants(obj.__class__, perm, instance_perm_classes)
+        if __class_perm_granted(cache, grants):
+            response[obj.pk] = True
+        else:
+            pending.setdefault(obj.__class__, {})[models.object_pk_value(obj.pk)] = obj.pk
+    for cls, object_pks in pending.items():
+        grants = __get_grants(cls, perm, instance_perm_classes)
+        content_type = __get_instance_perm_content_type(cls, perm)
+        granted = set()
+        querysets = __object_perm_querysets(user)
+        level_grants = [grants] + [hierarchy_grants for (path, ancestor, hierarchy_grants)
+            in __hierarchy_grants(cls, perm)]
+        chunk_size = __chunk_size(querysets, len(level_grants), sum(1 + len(codenames)
+            for level in level_grants for (content_type, codenames) in level))
+        for chunk in _chunks(object_pks.keys(), chunk_size):
+            levels = __perm_levels(cls, perm, grants, chunk)
+            rows = __union_values_list([qs.filter(__levels_q(levels)) for qs in querysets],
+                'content_type', 'object_pk', 'codename')
+            for (content_type_pk, object_pk, codename) in rows:
+                object_pk = models.object_pk_value(object_pk)
+                for (level_grants, pks) in levels:
+                    if object_pk in pks and [content_type for (content_type, codenames)
+                            in level_grants if content_type.pk == content_type_pk
+                            and codename in codenames]:
+                        granted.update(pks[object_pk])
+        for object_pk, pk in object_pks.items():
+            response[pk] = object_pk in granted
+            cache['object_perms'][(content_type.pk, object_pk, perm)] = response[pk]
+    return response
 
+@stats.instrumented('group_has_perm')
 def group_has_perm(self, perm, obj):
-    content_type = get_perm_content_type(obj, perm)
     if isinstance(obj, Model):
-        if models.GroupObjectPermission.objects.filter(content_type=content_type,
-                object_pk=obj.pk, group=self, codename=perm).exists():
-            return True
-    if models.GroupClassPermission.objects.filter(content_type=content_type,
-            group=self, codename=perm).exists():
-        return True
-    return False
+        grants = __get_grants(obj.__class__, perm, instance_perm_classes)
+    else:
+        grants = __get_grants(obj, perm, class_perm_classes)
+    querysets = [models.GroupClassPermission.objects.filter(
+        __grants_q(grants), group=self)]
+    if isinstance(obj, Model):
+        levels = __perm_levels(obj.__class__, perm, grants, [obj.pk], obj)
+        querysets.insert(0, models.GroupObjectPermission.objects.filter(
+            __levels_q(levels), group=self))
+    return __exists_any(querysets)
 
-def get_perms(self, obj):
+def __object_perm_querysets(principal, repeat=1):
+    """
+    Returns the querysets of the object perms the User or Group holds.
+    repeat is the number of times a query repeats them, to keep the
+    group pks it inlines within GROUP_PKS_INLINE_LIMIT.
     """
-    Get perms will return all permission codenames on an object or class.
+    if isinstance(principal, User):
+        if effective.enabled():
+            return [models.EffectivePermission.objects.filter(user=principal,
+                object_pk__isnull=False)]
+        querysets = [models.UserObjectPermission.objects.filter(user=principal)]
+        group_pks = __get_group_pks(principal)
+        if len(group_pks) * repeat > GROUP_PKS_INLINE_LIMIT:
+            querysets.append(models.GroupObjectPermission.objects.filter(
+                group__in=User.groups.through.objects.filter(user=principal).values('group')))
+        elif group_pks:
+            querysets.append(models.GroupObjectPermission.objects.filter(group__in=group_pks))
+        return querysets
+    return [models.GroupObjectPermission.objects.filter(group=principal)]
+
+def __chunk_size(querysets, levels, level_params):
+    """
+    Returns how many object pks each of levels can pass per query to the
+    UNION of querysets. level_params is the number of other parameters
+    the level lookups add to each queryset; with those the querysets
+    already pass, e.g. inlined group pks, the query stays within
+    MAX_QUERY_PARAMS.
+    """
+    fixed = sum(len(__compile(qs)[1]) + level_params for qs in querysets)
+    return max(1, min(QUERY_CHUNK_SIZE,
+        (MAX_QUERY_PARAMS - fixed) // (len(querysets) * levels)))
+
+def __cached_class_perms(user, content_type_pks):
+    """
+    Returns the (content_type_pk, codename) class perms the user holds on
+    content_type_pks, read from the permission cache.
+    """
+    class_perms = __get_perm_cache(user)['class_perms']
+    return set((content_type_pk, codename) for content_type_pk in content_type_pks
+        for codename in class_perms.get(content_type_pk, ()))
+
+def __registered_perms(cls, index):
+    model_perms = __model_perms(cls)
+    if index is class_perm_classes:
+        return set(model_perms.class_perms)
+    return set(model_perms.class_perms) | set(model_perms.object_perms)
 
-    This function is relatively expensive and has_perm should be used
-    when possible.
+def __perms_held(cls, index, held):
+    """
+    Returns the codenames registered on cls which are granted by the
+    (content_type_id, codename) pairs in held, following implications.
     """
     response = set()
+    for perm in __registered_perms(cls, index):
+        for content_type, codenames in __get_grants(cls, perm, index):
+            if [c for c in codenames if (content_type.pk, c) in held]:
+                response.add(perm)
+                break
+    return response
+
+def __perm_content_type_pks(cls, index):
+    return set(content_type.pk for perm in __registered_perms(cls, index)
+        for (content_type, codenames) in __get_grants(cls, perm, index))
+
+def __perm_ancestors(cls):
+    """
+    Returns the (path, ancestor) pairs of cls sharing perms with it.
+    """
+    perms = __registered_perms(cls, instance_perm_classes)
+    return [(path, ancestor) for (path, ancestor) in get_ancestor_paths(cls)
+        if __registered_perms(ancestor, instance_perm_classes) & perms]
+
+def __model_levels(cls, object_pks, instance=None):
+    """
+    Returns the (model, {object_pk: [object_pk, ...]}) levels any perm is
+    looked up on for the objects of cls, like __perm_levels does for one.
+    """
+    object_pks = [models.object_pk_value(object_pk) for object_pk in object_pks]
+    levels = [(cls, dict((object_pk, [object_pk]) for object_pk in object_pks))]
+    ancestors = __perm_ancestors(cls)
+    if ancestors:
+        levels += zip([ancestor for (path, ancestor) in ancestors],
+            __ancestor_levels(cls, [path for (path, ancestor) in ancestors],
+                object_pks, instance))
+    return levels
+
+def __model_levels_q(levels):
+    return reduce(operator.or_, [Q(object_pk__in=pks.keys(),
+        content_type__in=__perm_content_type_pks(model, instance_perm_classes))
+        for (model, pks) in levels if pks])
+
+def __perms_held_through(cls, index, ancestors, held):
+    """
+    Like __perms_held, also granting the perms of cls held on ancestors.
+    """
+    response = __perms_held(cls, index, held)
+    for ancestor in ancestors:
+        response |= __perms_held(ancestor, instance_perm_classes, held) & __registered_perms(cls, index)
+    return response
+
+@stats.instrumented('get_perms')
+def get_perms(self, obj):
+    """
+    Get perms will return all permission codenames a User or Group holds
+    on an object or class: directly, through groups, through class perms
+    and through implication.
+
+    A user's class perms come from their permission cache, every other
+    permission table, for the object and its ancestors, is read with a
+    single UNION query.
+    """
     if isinstance(obj, Model):
-        content_type = ContentType.objects.get_for_model(obj.__class__)
-        user_perms = models.UserObjectPermission.objects.filter(content_type=content_type).filter(object_pk=obj.pk).filter(user=self).values('codename')
-        response = response.union(__extract_codenames(user_perms))
+        (cls, index) = (obj.__class__, instance_perm_classes)
     elif issubclass(obj, Model):
-        content_type = ContentType.objects.get_for_model(obj)
-    user_cls_perms = models.UserClassPermission.objects.filter(content_type=content_type).filter(user=self).values('codename')
-    response = response.union(__extract_codenames(user_cls_perms))
-    return response
+        (cls, index) = (obj, class_perm_classes)
+    if isinstance(self, User) and self.is_superuser:
+        return __registered_perms(cls, index)
+    content_type_pks = __perm_content_type_pks(cls, index)
+    if not content_type_pks:
+        # the model declares no permissions
+        return set()
+    if isinstance(self, User):
+        held = __cached_class_perms(self, content_type_pks)
+        querysets = []
+    else:
+        held = set()
+        querysets = [models.GroupClassPermission.objects.filter(group=self,
+            content_type__in=content_type_pks)]
+    levels = []
+    if isinstance(obj, Model):
+        levels = __model_levels(cls, [obj.pk], obj)
+        querysets += [qs.filter(__model_levels_q(levels))
+            for qs in __object_perm_querysets(self)]
+    if querysets:
+        held.update(__union_values_list(querysets, 'content_type', 'codename'))
+    return __perms_held_through(cls, index, [model for (model, pks) in levels[1:]], held)
+
+@stats.instrumented('get_perms_many')
+def get_perms_many(self, objs):
+    """
+    Batch form of get_perms for many model instances, returning a dict
+    mapping each object's pk to its set of codenames. Like has_perms_many
+    the objects are keyed by pk, so they should be of a single model.
 
+    Class perms are read once and object perms, with those of the
+    objects' ancestors, with one UNION query per QUERY_CHUNK_SIZE
+    values of each class.
+    """
+    objs = list(objs)
+    by_class = {}
+    for obj in objs:
+        by_class.setdefault(obj.__class__, []).append(obj)
+    response = {}
+    for cls, cls_objs in by_class.items():
+        if isinstance(self, User) and self.is_superuser:
+            for obj in cls_objs:
+                response[obj.pk] = __registered_perms(cls, instance_perm_classes)
+            continue
+        content_type_pks = __perm_content_type_pks(cls, instance_perm_classes)
+        if not content_type_pks:
+            for obj in cls_objs:
+                response[obj.pk] = set()
+            continue
+        if isinstance(self, User):
+            class_held = __cached_class_perms(self, content_type_pks)
+        else:
+            stats.count('queries')
+            class_held = set(models.GroupClassPermission.objects.filter(group=self,
+                content_type__in=content_type_pks).values_list('content_type', 'codename'))
+        object_held = {}
+        object_pks = set(models.object_pk_value(obj.pk) for obj in cls_objs)
+        ancestors = [ancestor for (path, ancestor) in __perm_ancestors(cls)]
+        querysets = __object_perm_querysets(self)
+        chunk_size = __chunk_size(querysets, 1 + len(ancestors), sum(
+            len(__perm_content_type_pks(model, instance_perm_classes))
+            for model in [cls] + ancestors))
+        for chunk in _chunks(object_pks, chunk_size):
+            levels = __model_levels(cls, chunk)
+            rows = __union_values_list([qs.filter(__model_levels_q(levels)) for qs in querysets],
+                'object_pk', 'content_type', 'codename')
+            for (object_pk, content_type_pk, codename) in rows:
+                object_pk = models.object_pk_value(object_pk)
+                for (model, pks) in levels:
+                    if object_pk in pks and content_type_pk in __perm_content_type_pks(
+                            model, instance_perm_classes):
+                        for held_pk in pks[object_pk]:
+                            object_held.setdefault(held_pk, set()).add((content_type_pk, codename))
+        for obj in cls_objs:
+            held = class_held | object_held.get(models.object_pk_value(obj.pk), set())
+            response[obj.pk] = __perms_held_through(cls, instance_perm_classes, ancestors, held)
+    return response
 
+# The views are named by path, so importing cerberus, as every models
+# module does, doesn't import them and their dependencies.
 @classmethod
 def get_class_permissions_url(cls):
-    return reverse(permissions_view, kwargs={'clsname': cls.__name__.lower()})
+    return reverse('cerberus.views.permissions_view', kwargs={'clsname': cls.__name__.lower()})
 
 def get_object_permissions_url(self):
-    return reverse(permissions_view, kwargs={'clsname': self.__class__.__name__.lower(), 'obj_pk': self.pk})
+    return reverse('cerberus.views.permissions_view', kwargs={'clsname': self.__class__.__name__.lower(), 'obj_pk': self.pk})
 
 @classmethod
 def get_class_permissions_edit_url(cls):
-    return reverse(permissions_edit, kwargs={'clsname': cls.__name__.lower()})
+    return reverse('cerberus.views.permissions_edit', kwargs={'clsname': cls.__name__.lower()})
 
 def get_object_permissions_edit_url(self):
-    return reverse(permissions_edit, kwargs={'clsname': self.__class__.__name__.lower(), 'obj_pk': self.pk})
+    return reverse('cerberus.views.permissions_edit', kwargs={'clsname': self.__class__.__name__.lower(), 'obj_pk': self.pk})
 
 setattr(Model, 'get_class_permissions_edit_url', get_class_permissions_edit_url)
 setattr(Model, 'get_object_permissions_edit_url', get_object_permissions_edit_url)
@@ -294,4 +1388,6 @@ setattr(User, 'remove_perm', _remove_perm)
 setattr(Group, 'remove_perm', _remove_perm)
 setattr(User, 'get_perms', get_perms)
 setattr(Group, 'get_perms', get_perms)
+setattr(User, 'get_perms_many', get_perms_many)
+setattr(Group, 'get_perms_many', get_perms_many)
 setattr(Group, 'has_perm', group_has_perm)
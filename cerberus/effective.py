@@ -0,0 +1,180 @@
+"""
+Maintenance of the EffectivePermission table.
+
+When CERBERUS_EFFECTIVE_PERMISSIONS is set, every grant a user receives,
+directly or through a group, as object or class permission, is stored
+as one EffectivePermission row. Checks then need a single indexed lookup
+on that table instead of reading the four permission tables and joining
+through group memberships.
+
+The table is kept up to date by signals on the permission models and on
+User.groups, each write re-syncing only the rows it can affect. The
+cerberus_rebuild_effective command rebuilds it from scratch.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.models import Group
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete
+from django.db.models.signals import m2m_changed
+
+import cerberus
+import models
+
+# per thread, so that a bulk writer does not skip other threads' syncs
+_local = threading.local()
+
+def enabled():
+    return getattr(settings, 'CERBERUS_EFFECTIVE_PERMISSIONS', False)
+
+@contextmanager
+def suspended():
+    """
+    Stops the signal handlers from syncing, for bulk writers which sync
+    the users they touched once they are done. Only writes made by the
+    calling thread are skipped.
+    """
+    _local.suspended = getattr(_local, 'suspended', 0) + 1
+    try:
+        yield
+    finally:
+        _local.suspended -= 1
+
+def __is_suspended():
+    return getattr(_local, 'suspended', 0) > 0
+
+def __members(group_pks):
+    return User.groups.through.objects.filter(
+        group__in=group_pks).values_list('user', flat=True).distinct()
+
+def __granted_rows(user_pks, filters, objects, classes):
+    """
+    Returns the (user, content_type, object_pk, codename) rows the users
+    should hold according to the permission tables.
+    """
+    users_by_group = {}
+    for (user_id, group_id) in User.groups.through.objects.filter(
+            user__in=user_pks).values_list('user', 'group'):
+        users_by_group.setdefault(group_id, []).append(user_id)
+    rows = set()
+    sources = []
+    if objects:
+        sources += [(models.UserObjectPermission, 'user', True),
+            (models.GroupObjectPermission, 'group', True)]
+    if classes:
+        sources += [(models.UserClassPermission, 'user', False),
+            (models.GroupClassPermission, 'group', False)]
+    for (model, principal_field, is_object) in sources:
+        fields = [principal_field, 'content_type', 'codename']
+        if is_object:
+            fields.append('object_pk')
+        if principal_field == 'user':
+            qs = model.objects.filter(user__in=user_pks, **filters)
+        elif users_by_group:
+            qs = model.objects.filter(group__in=users_by_group.keys(), **filters)
+        else:
+            continue
+        for row in qs.values_list(*fields):
+            object_pk = models.object_pk_value(row[3]) if is_object else None
+            if principal_field == 'user':
+                rows.add((row[0], row[1], object_pk, row[2]))
+            else:
+                for user_id in users_by_group[row[0]]:
+                    rows.add((user_id, row[1], object_pk, row[2]))
+    return rows
+
+def sync(user_pks, object_pk=None, objects=True, classes=True, add=True,
+        remove=True, **filters):
+    """
+    Brings the EffectivePermission rows of the users in line with the
+    permission tables.
+
+    filters (content_type, codename, ...) narrow down the rows which are
+    compared, objects and classes pick the kind of permissions, and
+    object_pk narrows object permissions down to one object. add and
+    remove allow skipping missing or stale rows, e.g. a revoke can only
+    make rows stale.
+    """
+    if object_pk is not None:
+        filters['object_pk'] = object_pk
+        classes = False
+    effective = models.EffectivePermission.objects.filter(**filters)
+    if not objects:
+        effective = effective.filter(object_pk__isnull=True)
+    elif not classes:
+        effective = effective.filter(object_pk__isnull=False)
+    for chunk in cerberus._chunks(user_pks):
+        wanted = __granted_rows(chunk, filters, objects, classes)
+        current = {}
+        for (pk, user_id, content_type_id, object_pk, codename) in effective.filter(
+                user__in=chunk).values_list('pk', 'user', 'content_type', 'object_pk', 'codename'):
+            if object_pk is not None:
+                object_pk = models.object_pk_value(object_pk)
+            current[(user_id, content_type_id, object_pk, codename)] = pk
+        if remove:
+            stale = [pk for (row, pk) in current.items() if row not in wanted]
+            for stale_chunk in cerberus._chunks(stale):
+                models.EffectivePermission.objects.filter(pk__in=stale_chunk).delete()
+        if add:
+            cerberus._bulk_insert(models.EffectivePermission, [
+                models.EffectivePermission(user_id=row[0], content_type_id=row[1],
+                    object_pk=row[2], codename=row[3])
+                for row in wanted if row not in current])
+
+def rebuild():
+    """
+    Rebuilds the whole table.
+    """
+    sync(User.objects.values_list('pk', flat=True))
+
+def __permission_changed(sender, instance, **kwargs):
+    if not enabled() or __is_suspended():
+        return
+    if hasattr(instance, 'user_id'):
+        user_pks = [instance.user_id]
+    else:
+        user_pks = list(__members([instance.group_id]))
+    # grants can only add rows, revokes can only remove them
+    saved = 'created' in kwargs
+    if hasattr(instance, 'object_pk'):
+        sync(user_pks, object_pk=instance.object_pk, add=saved, remove=not saved,
+            content_type=instance.content_type_id, codename=instance.codename)
+    else:
+        sync(user_pks, objects=False, add=saved, remove=not saved,
+            content_type=instance.content_type_id, codename=instance.codename)
+
+def __membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not enabled() or __is_suspended():
+        return
+    added = action == 'post_add'
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            sync([instance.pk], add=added, remove=not added)
+    elif action == 'pre_clear':
+        # remember the members, they are gone by post_clear
+        instance._cerberus_members = list(__members([instance.pk]))
+    elif action == 'post_clear':
+        sync(instance._cerberus_members, add=False)
+    elif action in ('post_add', 'post_remove'):
+        sync(list(pk_set), add=added, remove=not added)
+
+def __group_deleting(sender, instance, **kwargs):
+    # memberships are removed without an m2m_changed signal
+    if enabled():
+        instance._cerberus_members = list(__members([instance.pk]))
+
+def __group_deleted(sender, instance, **kwargs):
+    if enabled():
+        sync(getattr(instance, '_cerberus_members', []), add=False)
+
+for model in (models.UserObjectPermission, models.GroupObjectPermission,
+        models.UserClassPermission, models.GroupClassPermission):
+    post_save.connect(__permission_changed, sender=model)
+    post_delete.connect(__permission_changed, sender=model)
+m2m_changed.connect(__membership_changed, sender=User.groups.through)
+pre_delete.connect(__group_deleting, sender=Group)
+post_delete.connect(__group_deleted, sender=Group)
@@ -0,0 +1,58 @@
+from django.core.management.base import NoArgsCommand
+
+import cerberus
+from cerberus.models import UserObjectPermission
+from cerberus.models import GroupObjectPermission
+from cerberus.models import UserClassPermission
+from cerberus.models import GroupClassPermission
+
+CHUNK_SIZE = 1000
+
+TABLES = (
+    (UserObjectPermission, 'user', True),
+    (GroupObjectPermission, 'group', True),
+    (UserClassPermission, 'user', False),
+    (GroupClassPermission, 'group', False),
+)
+
+def describe(row):
+    (principal_field, principal_pk, content_type_pk, object_pk, codename) = row
+    return "%s %s holding '%s' on content type %s%s" % (principal_field, principal_pk,
+        codename, content_type_pk, object_pk is not None and ", object %s" % object_pk or "")
+
+class Command(NoArgsCommand):
+    help = ("Lists users and groups holding permissions which cerberus_mutex "
+            "declares mutually exclusive, directly, through groups or through "
+            "class permissions.")
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        reported = set()
+        for (model, principal_field, is_object) in TABLES:
+            codenames = set(codename for (cls, codename, on_objects)
+                in cerberus.exclusive_perms if on_objects == is_object)
+            if not codenames:
+                continue
+            fields = [principal_field, 'content_type', 'object_pk', 'codename']
+            if not is_object:
+                fields.remove('object_pk')
+            last_pk = 0
+            while True:
+                # walk the table by primary key so memory stays flat
+                rows = list(model.objects.filter(pk__gt=last_pk, codename__in=codenames)
+                    .order_by('pk').values_list('pk', *fields)[:CHUNK_SIZE])
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+                for (row, held) in cerberus._exclusive_conflicts(principal_field,
+                        is_object, [row[1:] for row in rows]):
+                    # each pair is found from both of its rows
+                    pair = frozenset([(principal_field, ) + row, held])
+                    if pair in reported:
+                        continue
+                    reported.add(pair)
+                    if verbosity > 0:
+                        self.stdout.write("%s conflicts with %s\n" % (
+                            describe((principal_field, ) + row), describe(held)))
+        if verbosity > 0:
+            self.stdout.write("%d conflicting permission pairs found.\n" % len(reported))
@@ -0,0 +1,61 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.core.management.base import CommandError
+from django.conf import settings
+
+from cerberus.models import UserObjectPermission
+from cerberus.models import GroupObjectPermission
+
+CHUNK_SIZE = 1000
+
+def is_integer(value):
+    try:
+        return int(value) >= 0
+    except (TypeError, ValueError):
+        return False
+
+def is_uuid(value):
+    return value is not None and len(unicode(value)) <= 36
+
+CHECKS = {
+    'char': lambda value: True,
+    'integer': is_integer,
+    'uuid': is_uuid,
+}
+
+class Command(NoArgsCommand):
+    help = ("Checks that every stored object_pk can be converted to the given "
+            "column type. Run this before switching CERBERUS_OBJECT_PK_TYPE "
+            "and altering the object_pk columns of existing tables.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--type', dest='pk_type',
+            default=getattr(settings, 'CERBERUS_OBJECT_PK_TYPE', 'char'),
+            help="Column type to check against: char, integer or uuid."),
+        make_option('--delete', action='store_true', dest='delete', default=False,
+            help="Delete rows whose object_pk can not be converted."),
+    )
+
+    def handle_noargs(self, **options):
+        pk_type = options['pk_type']
+        if pk_type not in CHECKS:
+            raise CommandError("Unknown object_pk type %r." % pk_type)
+        check = CHECKS[pk_type]
+        verbosity = int(options.get('verbosity', 1))
+        for model in (UserObjectPermission, GroupObjectPermission):
+            invalid = []
+            last_pk = 0
+            while True:
+                # walk the table by primary key so memory stays flat
+                rows = list(model.objects.filter(pk__gt=last_pk).order_by('pk')
+                    .values_list('pk', 'object_pk')[:CHUNK_SIZE])
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+                invalid.extend(pk for (pk, object_pk) in rows if not check(object_pk))
+            if verbosity > 0:
+                self.stdout.write("%s: %d rows can not be stored as %s\n" % (
+                    model.__name__, len(invalid), pk_type))
+            if options['delete']:
+                for i in range(0, len(invalid), CHUNK_SIZE):
+                    model.objects.filter(pk__in=invalid[i:i + CHUNK_SIZE]).delete()
@@ -0,0 +1,83 @@
+import csv
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils import simplejson
+
+from cerberus.models import UserObjectPermission
+from cerberus.models import GroupObjectPermission
+from cerberus.models import UserClassPermission
+from cerberus.models import GroupClassPermission
+
+CHUNK_SIZE = 5000
+
+FIELDS = ('principal', 'principal_pk', 'content_type', 'object_pk', 'codename')
+
+TABLES = (
+    (UserObjectPermission, 'user', True),
+    (GroupObjectPermission, 'group', True),
+    (UserClassPermission, 'user', False),
+    (GroupClassPermission, 'group', False),
+)
+
+def export_rows(model, principal_field, is_object):
+    """
+    Yields every row of the permission table as a dict of FIELDS, with
+    content types as 'app_label.model' so they survive a move between
+    databases.
+    """
+    fields = ['pk', principal_field, 'content_type__app_label',
+        'content_type__model', 'codename']
+    if is_object:
+        fields.append('object_pk')
+    last_pk = 0
+    while True:
+        # walk the table by primary key so memory stays flat
+        rows = model.objects.filter(pk__gt=last_pk).order_by('pk').values_list(
+            *fields)[:CHUNK_SIZE]
+        count = 0
+        for row in rows.iterator():
+            count += 1
+            last_pk = row[0]
+            yield {
+                'principal': principal_field,
+                'principal_pk': row[1],
+                'content_type': '%s.%s' % (row[2], row[3]),
+                'object_pk': row[5] if is_object else None,
+                'codename': row[4],
+            }
+        if count < CHUNK_SIZE:
+            break
+
+class Command(BaseCommand):
+    args = '[file]'
+    help = ("Streams every user and group, object and class permission row "
+            "to file, or standard output, as JSON Lines or CSV for "
+            "cerberus_import.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='jsonl',
+            help="Output format: jsonl (the default) or csv."),
+    )
+
+    def handle(self, *args, **options):
+        if options['format'] not in ('jsonl', 'csv'):
+            raise CommandError("Unknown format %r." % options['format'])
+        if len(args) > 1:
+            raise CommandError("Export takes at most one file.")
+        output = args and open(args[0], 'wb') or self.stdout
+        try:
+            if options['format'] == 'csv':
+                writer = csv.writer(output)
+                writer.writerow(FIELDS)
+                write = lambda row: writer.writerow([
+                    '' if row[field] is None else unicode(row[field]).encode('utf-8')
+                    for field in FIELDS])
+            else:
+                write = lambda row: output.write(simplejson.dumps(row) + '\n')
+            for table in TABLES:
+                for row in export_rows(*table):
+                    write(row)
+        finally:
+            if args:
+                output.close()
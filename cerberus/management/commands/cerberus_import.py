@@ -0,0 +1,199 @@
+import csv
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db import IntegrityError
+from django.utils import simplejson
+
+import cerberus
+from cerberus import effective
+from cerberus import shared_cache
+from cerberus.models import UserObjectPermission
+from cerberus.models import GroupObjectPermission
+from cerberus.models import UserClassPermission
+from cerberus.models import GroupClassPermission
+
+MODELS = {
+    ('user', True): UserObjectPermission,
+    ('group', True): GroupObjectPermission,
+    ('user', False): UserClassPermission,
+    ('group', False): GroupClassPermission,
+}
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ("Loads permission rows written by cerberus_export from file, or "
+            "standard input for '-'. Rows are inserted in batches of "
+            "BULK_BATCH_SIZE, each in its own transaction, and checked "
+            "against cerberus_mutex.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help="Input format: jsonl or csv, guessed from the file name by default."),
+        make_option('--upsert', action='store_true', dest='upsert', default=False,
+            help="Skip rows which already exist instead of failing on them."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Import takes exactly one file.")
+        format = options['format'] or (args[0].endswith('.csv') and 'csv' or 'jsonl')
+        if format not in ('jsonl', 'csv'):
+            raise CommandError("Unknown format %r." % format)
+        verbosity = int(options.get('verbosity', 1))
+        self.content_types = {}
+        source = args[0] == '-' and sys.stdin or open(args[0], 'rb')
+        try:
+            if format == 'csv':
+                reader = csv.DictReader(source)
+                # line_num counts the header and quoted line breaks
+                rows = ((reader.line_num, row) for row in reader)
+            else:
+                rows = ((line, text) for (line, text) in enumerate(source, 1)
+                    if text.strip())
+            imported = self.load(rows, options['upsert'])
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        if effective.enabled() and not options['upsert']:
+            effective.rebuild()
+        cerberus.invalidate_perm_cache()
+        if verbosity > 0:
+            self.stdout.write("Loaded %d permission rows\n" % imported)
+
+    def load(self, rows, upsert):
+        """
+        Writes the rows, (line, row) pairs with rows as CSV dicts or JSON
+        text, in batches per table.
+        """
+        batches = dict((key, []) for key in MODELS)
+        self.imported = 0
+        for (line, row) in rows:
+            (key, perm_row) = self.parse(line, row)
+            batches[key].append((line, perm_row))
+            if len(batches[key]) >= cerberus.BULK_BATCH_SIZE:
+                self.imported += self.write(key, batches[key], upsert)
+                batches[key] = []
+        for key, batch in batches.items():
+            if batch:
+                self.imported += self.write(key, batch, upsert)
+        return self.imported
+
+    def parse(self, line, row):
+        """
+        Returns the (principal_field, is_object) table and the row to write
+        for a line, checking the codename against the registry.
+        """
+        try:
+            if isinstance(row, basestring):
+                row = simplejson.loads(row)
+            principal_field = row['principal']
+            object_pk = row['object_pk']
+            if object_pk == '':
+                # how CSV writes class permissions
+                object_pk = None
+            is_object = object_pk is not None
+            content_type = self.get_content_type(row['content_type'])
+            perm_row = (int(row['principal_pk']), content_type.pk, object_pk, row['codename'])
+        except (KeyError, TypeError, ValueError, ContentType.DoesNotExist), e:
+            raise CommandError("Line %d: invalid row (%s)." % (line, e))
+        if principal_field not in ('user', 'group'):
+            raise CommandError("Line %d: unknown principal %r." % (line, principal_field))
+        cls = content_type.model_class()
+        if cls not in cerberus.perms_dict:
+            raise CommandError("Line %d: %s has no registered permissions." % (
+                line, row['content_type']))
+        if is_object:
+            (perms, defining) = (cerberus.get_object_perms(cls), cerberus.instance_perm_classes)
+        else:
+            (perms, defining) = (cerberus.get_class_perms(cls), cerberus.class_perm_classes)
+        if row['codename'] not in perms:
+            raise CommandError("Line %d: '%s' is not a registered %s permission of %s." % (
+                line, row['codename'], is_object and 'object' or 'class', row['content_type']))
+        # inherited permissions are stored under the model defining them,
+        # rows under any other content type are never read
+        stored_under = cerberus.get_class_content_type(defining[(cls, row['codename'])])
+        if stored_under.pk != content_type.pk:
+            raise CommandError("Line %d: '%s' is stored under %s, not %s." % (
+                line, row['codename'], '.'.join(stored_under.natural_key()), row['content_type']))
+        return ((principal_field, is_object), perm_row)
+
+    def get_content_type(self, natural_key):
+        if natural_key not in self.content_types:
+            (app_label, model) = natural_key.split('.', 1)
+            self.content_types[natural_key] = ContentType.objects.get_by_natural_key(
+                app_label, model)
+        return self.content_types[natural_key]
+
+    def write(self, key, batch, upsert):
+        """
+        Writes a batch of (line, row) pairs, turning failures into a
+        CommandError naming the first line at fault.
+        """
+        (principal_field, is_object) = key
+        rows = [row for (line, row) in batch]
+        try:
+            if upsert:
+                # skips existing rows and keeps caches and effective rows in sync
+                cerberus._bulk_write_perms(principal_field, is_object, grants=rows)
+            else:
+                conflicts = cerberus._exclusive_conflicts(principal_field, is_object, rows)
+                if conflicts:
+                    raise cerberus.PermissionConflict(conflicts)
+                self.insert(principal_field, is_object, rows)
+        except cerberus.PermissionConflict, e:
+            granted = set(row for (row, held) in e.conflicts)
+            lines = [line for (line, row) in batch
+                if self.normalize(is_object, row) in granted]
+            self.fail(lines and min(lines) or None, e)
+        except IntegrityError, e:
+            self.fail(self.duplicate_line(principal_field, is_object, batch), e)
+        return len(rows)
+
+    def insert(self, principal_field, is_object, rows):
+        model = MODELS[(principal_field, is_object)]
+        objs = []
+        for (principal_pk, content_type_id, object_pk, codename) in rows:
+            kwargs = {principal_field + '_id': principal_pk,
+                'content_type_id': content_type_id, 'codename': codename}
+            if is_object:
+                kwargs['object_pk'] = object_pk
+            objs.append(model(**kwargs))
+        with transaction.commit_on_success(using=model.objects.db), effective.suspended():
+            cerberus._bulk_insert(model, objs)
+        for principal_pk in set(row[0] for row in rows):
+            shared_cache.bump_version(principal_field, principal_pk)
+
+    def normalize(self, is_object, row):
+        # rows as _exclusive_conflicts returns them
+        if is_object:
+            return row[:2] + (cerberus.models.object_pk_value(row[2]), row[3])
+        return row
+
+    def duplicate_line(self, principal_field, is_object, batch):
+        """
+        Returns the line of the first row of batch which is repeated in
+        it or already stored, or None.
+        """
+        model = MODELS[(principal_field, is_object)]
+        seen = set()
+        for (line, row) in batch:
+            row = self.normalize(is_object, row)
+            kwargs = {principal_field: row[0], 'content_type': row[1], 'codename': row[3]}
+            if is_object:
+                kwargs['object_pk'] = row[2]
+            if row in seen or model.objects.filter(**kwargs).exists():
+                return line
+            seen.add(row)
+        return None
+
+    def fail(self, line, error):
+        if line is None:
+            message = unicode(error)
+        else:
+            message = "Line %d: %s" % (line, error)
+        raise CommandError("%s. %d rows were loaded before the batch failed, "
+            "pass --upsert to skip them when importing again." % (message, self.imported))
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from django.core.management.base import CommandError
+
+from cerberus import effective
+
+class Command(NoArgsCommand):
+    help = ("Rebuilds the EffectivePermission table from the user and group "
+            "permission tables.")
+
+    def handle_noargs(self, **options):
+        if not effective.enabled():
+            raise CommandError("CERBERUS_EFFECTIVE_PERMISSIONS is not set.")
+        effective.rebuild()
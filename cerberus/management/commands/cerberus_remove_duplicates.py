@@ -0,0 +1,30 @@
+from django.core.management.base import NoArgsCommand
+from django.db.models import Count
+from django.db.models import Min
+
+from cerberus.models import UserObjectPermission
+from cerberus.models import GroupObjectPermission
+from cerberus.models import UserClassPermission
+from cerberus.models import GroupClassPermission
+
+class Command(NoArgsCommand):
+    help = ("Deletes duplicate permission rows, keeping the oldest of each. "
+            "Run this before adding the unique constraints to existing tables.")
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in (UserObjectPermission, GroupObjectPermission,
+                UserClassPermission, GroupClassPermission):
+            fields = model._meta.unique_together[0]
+            removed = 0
+            duplicates = model.objects.values(*fields).annotate(
+                count=Count('id'), keep=Min('id')).filter(count__gt=1)
+            for row in duplicates:
+                keep = row.pop('keep')
+                row.pop('count')
+                rows = model.objects.filter(**row).exclude(pk=keep)
+                removed += rows.count()
+                rows.delete()
+            if verbosity > 0:
+                self.stdout.write("%s: removed %d duplicate rows\n" % (
+                    model.__name__, removed))
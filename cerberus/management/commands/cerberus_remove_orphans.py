@@ -0,0 +1,73 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.core.exceptions import ValidationError
+from django.contrib.contenttypes.models import ContentType
+
+import cerberus
+from cerberus import effective
+from cerberus.models import UserObjectPermission
+from cerberus.models import GroupObjectPermission
+from cerberus.models import EffectivePermission
+
+def find_orphans(model, content_type):
+    """
+    Yields chunks of pks of the rows of model stored under content_type
+    whose object no longer exists.
+
+    Rows are walked by pk and anti-joined against the object table one
+    chunk at a time, in Python as object_pk and the object's primary key
+    may be of different column types.
+    """
+    cls = content_type.model_class()
+    last_pk = 0
+    while True:
+        rows = list(model.objects.filter(pk__gt=last_pk, content_type=content_type,
+            object_pk__isnull=False).order_by('pk').values_list(
+            'pk', 'object_pk')[:cerberus.QUERY_CHUNK_SIZE])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+        if cls is None:
+            # the model is gone, and all its objects with it
+            yield [pk for (pk, object_pk) in rows]
+            continue
+        object_pks = {}
+        for (pk, object_pk) in rows:
+            try:
+                object_pks.setdefault(cls._meta.pk.to_python(object_pk), []).append(pk)
+            except ValidationError:
+                object_pks.setdefault(None, []).append(pk)
+        existing = set(cls._default_manager.filter(
+            pk__in=[key for key in object_pks if key is not None]).values_list('pk', flat=True))
+        orphans = [pk for (object_pk, pks) in object_pks.items()
+            if object_pk not in existing for pk in pks]
+        if orphans:
+            yield orphans
+
+class Command(NoArgsCommand):
+    help = ("Deletes object permission rows whose objects have been deleted, "
+            "e.g. before cerberus removed them on delete.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help="Only count the orphaned rows."),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        perm_models = [UserObjectPermission, GroupObjectPermission]
+        if effective.enabled():
+            perm_models.append(EffectivePermission)
+        for model in perm_models:
+            content_type_pks = model.objects.values_list('content_type', flat=True).distinct()
+            for content_type in ContentType.objects.filter(pk__in=list(content_type_pks)):
+                found = 0
+                for orphans in find_orphans(model, content_type):
+                    found += len(orphans)
+                    if not options['dry_run']:
+                        with effective.suspended():
+                            model.objects.filter(pk__in=orphans).delete()
+                if verbosity > 0 and found:
+                    self.stdout.write("%s: %d orphaned rows for %s.%s\n" % (model.__name__,
+                        found, content_type.app_label, content_type.model))
+        cerberus.invalidate_perm_cache()
@@ -0,0 +1,29 @@
+import logging
+
+from django.conf import settings
+
+import stats
+
+logger = logging.getLogger('cerberus')
+
+class PermissionStatsMiddleware(object):
+    """
+    Collects the permission checks made while handling each request. The
+    summary is logged at DEBUG level to the 'cerberus' logger, and added
+    as X-Cerberus-* response headers when DEBUG is on.
+    """
+    def process_request(self, request):
+        request.cerberus_stats = stats.start_collecting()
+
+    def process_response(self, request, response):
+        collected = getattr(request, 'cerberus_stats', None)
+        if collected is None:
+            return response
+        stats.stop_collecting(collected)
+        del request.cerberus_stats
+        logger.debug('%s %s: %s', request.method, request.path, collected.summary())
+        if settings.DEBUG:
+            response['X-Cerberus-Checks'] = str(collected.totals['checks'])
+            response['X-Cerberus-Queries'] = str(collected.totals['queries'])
+            response['X-Cerberus-Time'] = '%.4f' % collected.totals['duration']
+        return response
@@ -1,23 +1,55 @@
 from django.db import models
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.contrib.auth.models import Permission, PermissionManager
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.contrib.auth.models import User, Group
 from django.utils.translation import ugettext_lazy as _
 
+def object_pk_field(**kwargs):
+    """
+    Builds the object_pk column for object permissions.
+
+    CERBERUS_OBJECT_PK_TYPE picks the column type: 'char' (the default)
+    works with any primary key, 'integer' matches AutoField primary keys
+    and 'uuid' stores 36 character UUID strings. A column matching the
+    protected models' primary keys keeps indexes narrow and lets joins
+    against those tables skip casts.
+    """
+    pk_type = getattr(settings, 'CERBERUS_OBJECT_PK_TYPE', 'char')
+    if pk_type == 'char':
+        return models.CharField(_('object ID'), max_length=255, **kwargs)
+    elif pk_type == 'integer':
+        return models.PositiveIntegerField(_('object ID'), **kwargs)
+    elif pk_type == 'uuid':
+        return models.CharField(_('object ID'), max_length=36, **kwargs)
+    raise ImproperlyConfigured("CERBERUS_OBJECT_PK_TYPE must be one of "
+        "'char', 'integer' or 'uuid', not %r." % pk_type)
+
+def object_pk_value(pk):
+    """
+    Converts a primary key to the python type stored in object_pk.
+    """
+    return ObjectPermissionBase._meta.get_field('object_pk').to_python(pk)
+
 class ObjectPermissionBase(models.Model):
     codename = models.CharField(_('codename'), max_length=100)
     content_type = models.ForeignKey(ContentType)
-    object_pk = models.CharField(_('object ID'), max_length=255)
+    object_pk = object_pk_field()
     content_object = generic.GenericForeignKey(ct_field="content_type", fk_field="object_pk")
     class Meta:
         abstract = True
 
 class UserObjectPermission(ObjectPermissionBase):
     user = models.ForeignKey(User)
+    class Meta:
+        unique_together = (('user', 'content_type', 'codename', 'object_pk'),)
 
 class GroupObjectPermission(ObjectPermissionBase):
     group = models.ForeignKey(Group)
+    class Meta:
+        unique_together = (('group', 'content_type', 'codename', 'object_pk'),)
 
 class ClassPermissionBase(models.Model):
     codename = models.CharField(_('codename'), max_length=100)
@@ -27,6 +59,23 @@ class ClassPermissionBase(models.Model):
  
 class UserClassPermission(ClassPermissionBase):
     user = models.ForeignKey(User)
+    class Meta:
+        unique_together = (('user', 'content_type', 'codename'),)
 
 class GroupClassPermission(ClassPermissionBase):
     group = models.ForeignKey(Group)
+    class Meta:
+        unique_together = (('group', 'content_type', 'codename'),)
+
+class EffectivePermission(models.Model):
+    """
+    Materialized permissions a user holds, directly or through groups.
+    Class permissions are stored with a NULL object_pk. Only maintained
+    when CERBERUS_EFFECTIVE_PERMISSIONS is set, see cerberus.effective.
+    """
+    user = models.ForeignKey(User)
+    codename = models.CharField(_('codename'), max_length=100)
+    content_type = models.ForeignKey(ContentType)
+    object_pk = object_pk_field(null=True)
+    class Meta:
+        unique_together = (('user', 'content_type', 'codename', 'object_pk'),)
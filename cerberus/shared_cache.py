@@ -0,0 +1,86 @@
+"""
+Permission data shared between processes through Django's cache framework.
+
+This is enabled by setting CERBERUS_CACHE to the alias of a configured
+cache. Entries are stored under a version kept per user or group, and
+every write to that principal's permissions or group memberships replaces
+the version, so stale entries are never read again and simply expire.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import transaction
+
+_caches = {}
+
+def get_shared_cache(using=None):
+    """
+    Returns the cache configured by CERBERUS_CACHE, or None when the
+    shared cache is disabled. It is also None while the using database
+    is in a transaction with uncommitted writes: entries read there may
+    not reflect them, and entries stored there would outlive a rollback.
+    """
+    alias = getattr(settings, 'CERBERUS_CACHE', None)
+    if alias is None:
+        return None
+    if using is not None and transaction.is_managed(using=using) \
+            and transaction.is_dirty(using=using):
+        return None
+    if alias not in _caches:
+        _caches[alias] = get_cache(alias)
+    return _caches[alias]
+
+def __timeout():
+    return getattr(settings, 'CERBERUS_CACHE_TIMEOUT', 3600)
+
+def __version_key(kind, pk):
+    return 'cerberus:%s:%s:version' % (kind, pk)
+
+def __entry_key(kind, pk, version):
+    return 'cerberus:%s:%s:%s' % (kind, pk, version)
+
+def get_versions(cache, kind, pks):
+    """
+    Returns a dict mapping each pk to the current version of its entry,
+    creating versions which are missing. pks whose version can not be
+    read back, e.g. while the cache is down, are left out.
+    """
+    keys = dict((__version_key(kind, pk), pk) for pk in pks)
+    found = cache.get_many(keys.keys())
+    missing = [key for key in keys if key not in found]
+    if missing:
+        for key in missing:
+            # add() keeps a version created concurrently by another process
+            cache.add(key, uuid.uuid4().hex, __timeout())
+        found.update(cache.get_many(missing))
+    return dict((keys[key], version) for (key, version) in found.items())
+
+def bump_version(kind, pk):
+    """
+    Invalidates every entry stored for the principal.
+    """
+    cache = get_shared_cache()
+    if cache is not None:
+        cache.set(__version_key(kind, pk), uuid.uuid4().hex, __timeout())
+
+def get_entries(cache, kind, versions):
+    """
+    Returns a dict mapping pks to their entries for the provided
+    {pk: version} dict. Missing entries are left out.
+    """
+    keys = dict((__entry_key(kind, pk, version), pk)
+        for (pk, version) in versions.items())
+    found = cache.get_many(keys.keys())
+    return dict((keys[key], value) for (key, value) in found.items())
+
+def set_entries(cache, kind, versions, entries):
+    """
+    Stores the {pk: entry} dict under the versions from get_versions.
+    Entries without a version are not stored, as no write could
+    invalidate them; they are loaded from the database every time.
+    """
+    entries = dict((__entry_key(kind, pk, versions[pk]), entry)
+        for (pk, entry) in entries.items() if pk in versions)
+    if entries:
+        cache.set_many(entries, __timeout())
@@ -0,0 +1,4 @@
+-- The unique constraint leads with the group, which serves per-principal
+-- lookups. Per-object lookups (every group holding a permission on one
+-- object) need an index leading with the object instead.
+CREATE INDEX cerberus_groupobjectpermission_object ON cerberus_groupobjectpermission (content_type_id, object_pk, codename);
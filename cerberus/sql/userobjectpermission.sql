@@ -0,0 +1,4 @@
+-- The unique constraint leads with the user, which serves per-principal
+-- lookups. Per-object lookups (every user holding a permission on one
+-- object) need an index leading with the object instead.
+CREATE INDEX cerberus_userobjectpermission_object ON cerberus_userobjectpermission (content_type_id, object_pk, codename);
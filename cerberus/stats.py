@@ -0,0 +1,156 @@
+"""
+Instrumentation of permission checks.
+
+Every instrumented call (has_perm, has_perms_many, objects_with_perm,
+get_perms, ...) sends the permission_checked signal with the number of
+queries it issued, whether it was answered from cache, and how long it
+took. Nothing is measured while the signal has no receivers.
+
+PermissionStats aggregates those per codename and model; collect() and
+PermissionStatsMiddleware scope one to a block of code or a request.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.dispatch import Signal
+from django.db.models import Model
+
+permission_checked = Signal(providing_args=['principal', 'codename', 'model',
+    'result', 'queries', 'cache_hits', 'cache_misses', 'duration'])
+
+_local = threading.local()
+
+def count(key, n=1):
+    """
+    Adds n to the counter key ('queries', 'cache_hits' or 'cache_misses')
+    of every instrumented call in progress in this thread.
+    """
+    for counters in getattr(_local, 'counters', ()):
+        counters[key] += n
+
+def __describe(args):
+    codename = None
+    if len(args) > 2 and isinstance(args[1], basestring):
+        codename = args[1]
+    target = args[-1]
+    if isinstance(target, Model):
+        model = target.__class__
+    elif isinstance(target, type) and issubclass(target, Model):
+        model = target
+    else:
+        model = getattr(target, 'model', None)
+    return (args[0], codename, model)
+
+def instrumented(name):
+    """
+    Decorates a check function taking (principal, [codename,] target)
+    so that each call sends permission_checked with sender name.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not permission_checked.receivers:
+                return func(*args, **kwargs)
+            counters = {'queries': 0, 'cache_hits': 0, 'cache_misses': 0}
+            if not hasattr(_local, 'counters'):
+                _local.counters = []
+            _local.counters.append(counters)
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                duration = time.time() - start
+                _local.counters.remove(counters)
+            (principal, codename, model) = __describe(args)
+            permission_checked.send(sender=name, principal=principal,
+                codename=codename, model=model, result=result,
+                duration=duration, **counters)
+            return result
+        return wrapper
+    return decorator
+
+class PermissionStats(object):
+    """
+    Aggregates permission_checked signals, per (sender, codename, model)
+    in by_perm and overall in totals.
+    """
+    def __init__(self):
+        self.by_perm = {}
+        self.totals = self.__empty()
+
+    def __empty(self):
+        return {'checks': 0, 'queries': 0, 'cache_hits': 0, 'cache_misses': 0,
+            'duration': 0.0}
+
+    def record(self, sender, codename, model, queries, cache_hits, cache_misses,
+            duration, **kwargs):
+        if model is not None:
+            model = '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+        key = (sender, codename, model)
+        if key not in self.by_perm:
+            self.by_perm[key] = self.__empty()
+        for stats in (self.by_perm[key], self.totals):
+            stats['checks'] += 1
+            stats['queries'] += queries
+            stats['cache_hits'] += cache_hits
+            stats['cache_misses'] += cache_misses
+            stats['duration'] += duration
+
+    def summary(self):
+        lines = ['%(checks)d permission checks, %(queries)d queries, '
+            '%(cache_hits)d cache hits, %(cache_misses)d cache misses, '
+            '%(duration).4fs' % self.totals]
+        for (sender, codename, model), stats in sorted(self.by_perm.items(),
+                key=lambda item: -item[1]['duration']):
+            lines.append('  %s %s on %s: %d checks, %d queries, %.4fs' % (
+                sender, codename or '*', model or '*', stats['checks'],
+                stats['queries'], stats['duration']))
+        return '\n'.join(lines)
+
+def __collect(sender, **kwargs):
+    for stats in getattr(_local, 'collectors', ()):
+        stats.record(sender, **kwargs)
+
+# The receiver is shared by every thread, so it stays connected while any
+# thread is collecting.
+_collecting = [0]
+_collecting_lock = threading.Lock()
+
+def start_collecting():
+    """
+    Returns a PermissionStats recording every check in this thread until
+    stop_collecting is called with it.
+    """
+    with _collecting_lock:
+        if not _collecting[0]:
+            permission_checked.connect(__collect, dispatch_uid='cerberus.stats')
+        _collecting[0] += 1
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    stats = PermissionStats()
+    _local.collectors.append(stats)
+    return stats
+
+def stop_collecting(stats):
+    _local.collectors.remove(stats)
+    with _collecting_lock:
+        _collecting[0] -= 1
+        if not _collecting[0]:
+            permission_checked.disconnect(dispatch_uid='cerberus.stats')
+
+@contextmanager
+def collect():
+    """
+    Records the checks made in a with block:
+
+        with stats.collect() as collected:
+            ...
+        print collected.summary()
+    """
+    stats = start_collecting()
+    try:
+        yield stats
+    finally:
+        stop_collecting(stats)
@@ -1,16 +1,50 @@
+from __future__ import absolute_import
+
 from django import template
 from django.template.defaultfilters import register
 
+import cerberus
+
 register = template.Library()
 
 class CerberusNode(template.Node):
-    def __init__(self, user, obj, context_var):
+    def __init__(self, user, object_list, context_var):
         self.user = template.Variable(user)
-        self.obj = template.Variable(obj)
+        self.object_list = template.Variable(object_list)
         self.context_var = context_var
 
     def render(self, context):
-        pass
+        user = self.user.resolve(context)
+        object_list = self.object_list.resolve(context)
+        if user.is_authenticated():
+            context[self.context_var] = cerberus.get_perms_many(user, object_list)
+        else:
+            context[self.context_var] = dict((obj.pk, set()) for obj in object_list)
+        return ''
+
+@register.tag(name='cerberus_perms')
+def cerberus_perms(parser, token):
+    """
+    Fetches the codenames a user holds on every object of a list in a
+    constant number of queries:
+
+        {% cerberus_perms user animals as perms %}
+        {% for animal in animals %}
+            {% if "pet" in perms|perms_for:animal %}...{% endif %}
+        {% endfor %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 5 or bits[3] != 'as':
+        raise template.TemplateSyntaxError(
+            "%r tag requires the form {%% %s user object_list as var %%}" % (bits[0], bits[0]))
+    return CerberusNode(bits[1], bits[2], bits[4])
+
+@register.filter(name='perms_for')
+def perms_for(perms, obj):
+    """
+    Returns the codenames held on obj from a {% cerberus_perms %} result.
+    """
+    return perms.get(obj.pk, set())
 
 @register.filter(name='lookup')
 def lookup(dict, index):
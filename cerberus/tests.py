@@ -1,5 +1,8 @@
 from django.db import models
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.core.management import call_command
+from django.conf import settings
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
@@ -125,6 +128,13 @@ class UserInheritanceTest(TestCase):
     def test_superclass_permissions(self):
         self.user.set_perm('pet', BasicAnimal)
         self.assertTrue(self.user.has_perm('pet', self.fido))
+    def test_remove_inherited(self):
+        self.user.set_perm('pet', self.fido)
+        self.user.remove_perm('pet', self.fido)
+        self.assertFalse(self.user.has_perm('pet', self.fido))
+        self.user.set_perm('pet', BasicDog)
+        self.user.remove_perm('pet', BasicDog)
+        self.assertFalse(self.user.has_perm('pet', self.fido))
 
 class GroupInheritanceTest(TestCase):
     def setUp(self):
@@ -176,3 +186,1333 @@ class AbstractInheritanceTest(TestCase):
         self.assertFalse(self.user.has_perm('pet', self.fido))
         self.user.set_perm('pet', self.fido)
         self.assertTrue(self.user.has_perm('pet', self.fido))
+
+class SingleQueryTest(TestCase):
+    """
+    Permission checks should cost a single query regardless
+    of which permission table grants them.
+    """
+    def setUp(self):
+        self.fido = BasicDog(name="fido", breed="Golden Lab")
+        self.fido.save()
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.user.groups.add(self.group)
+        # warm the ContentType cache
+        cerberus.get_perm_content_type(self.fido, 'pet')
+    def test_object_check_single_query(self):
+        # loading the class permission cache
+        self.assertNumQueries(1, lambda: self.user.has_perm('eat', BasicDog))
+        self.assertNumQueries(1, lambda: self.user.has_perm('pet', self.fido))
+        self.assertFalse(self.user.has_perm('pet', self.fido))
+    def test_class_check_single_query(self):
+        self.assertNumQueries(1, lambda: self.user.has_perm('eat', BasicDog))
+        self.assertFalse(self.user.has_perm('eat', BasicDog))
+        self.group.set_perm('eat', BasicAnimal)
+        self.assertTrue(self.user.has_perm('eat', BasicDog))
+    def test_group_check_single_query(self):
+        self.assertNumQueries(1, lambda: self.group.has_perm('pet', self.fido))
+        self.group.set_perm('pet', self.fido)
+        self.assertTrue(self.group.has_perm('pet', self.fido))
+
+class PermCacheTest(TestCase):
+    """
+    Checks are answered from a cache on the user which
+    permission and group membership writes invalidate.
+    """
+    def setUp(self):
+        self.fido = BasicAnimal(name="fido")
+        self.fido.save()
+        self.rex = BasicAnimal(name="rex")
+        self.rex.save()
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+
+        self.group = Group(name='testgroup')
+        self.group.save()
+        cerberus.get_perm_content_type(self.fido, 'pet')
+    def test_repeated_checks_cached(self):
+        self.user.set_perm('eat', BasicAnimal)
+        self.assertTrue(self.user.has_perm('eat', BasicAnimal))
+        self.assertNumQueries(0, lambda: self.user.has_perm('eat', BasicAnimal))
+        self.assertNumQueries(0, lambda: self.user.has_perm('eat', self.fido))
+        self.assertFalse(self.user.has_perm('pet', self.fido))
+        self.assertNumQueries(0, lambda: self.user.has_perm('pet', self.fido))
+    def test_class_perm_answers_objects_from_memory(self):
+        self.user.set_perm('pet', BasicAnimal)
+        self.assertTrue(self.user.has_perm('pet', self.fido))
+        self.assertNumQueries(0, lambda: self.user.has_perm('pet', self.rex))
+    def test_write_invalidates(self):
+        self.assertFalse(self.user.has_perm('pet', self.fido))
+        self.user.set_perm('pet', self.fido)
+        self.assertTrue(self.user.has_perm('pet', self.fido))
+        self.user.remove_perm('pet', self.fido)
+        self.assertFalse(self.user.has_perm('pet', self.fido))
+    def test_group_write_invalidates(self):
+        self.user.groups.add(self.group)
+        self.assertFalse(self.user.has_perm('eat', BasicAnimal))
+        self.group.set_perm('eat', BasicAnimal)
+        self.assertTrue(self.user.has_perm('eat', BasicAnimal))
+    def test_group_pks_memoized(self):
+        from django.db import connection
+        self.user.groups.add(self.group)
+        self.group.set_perm('pet', self.fido)
+        self.assertFalse(self.user.has_perm('eat', BasicAnimal))
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            start = len(connection.queries)
+            self.assertTrue(self.user.has_perm('pet', self.fido))
+            self.assertFalse(self.user.has_perm('pet', self.rex))
+            sql = [query['sql'] for query in connection.queries[start:]]
+        finally:
+            settings.DEBUG = old_debug
+        self.assertEqual(2, len(sql))
+        self.assertFalse([s for s in sql if 'auth_user_groups' in s])
+    def test_membership_invalidates(self):
+        self.group.set_perm('pet', self.fido)
+        self.assertFalse(self.user.has_perm('pet', self.fido))
+        self.user.groups.add(self.group)
+        self.assertTrue(self.user.has_perm('pet', self.fido))
+        self.user.groups.remove(self.group)
+        self.assertFalse(self.user.has_perm('pet', self.fido))
+
+class ObjectsWithPermTest(TestCase):
+    def setUp(self):
+        self.fido = BasicDog(name="fido", breed="Golden Lab")
+        self.fido.save()
+        self.rex = BasicDog(name="rex", breed="Boxer")
+        self.rex.save()
+        self.spot = BasicDog(name="spot", breed="Dalmatian")
+        self.spot.save()
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.user.groups.add(self.group)
+    def test_object_perms(self):
+        dogs = cerberus.objects_with_perm(self.user, 'pet', BasicDog.objects.all())
+        self.assertEqual([], list(dogs))
+        self.user.set_perm('pet', self.fido)
+        self.group.set_perm('pet', self.rex)
+        dogs = cerberus.objects_with_perm(self.user, 'pet', BasicDog.objects.all())
+        self.assertEqual(set([self.fido.pk, self.rex.pk]), set(d.pk for d in dogs))
+        self.assertNumQueries(1, lambda: list(dogs.all()))
+    def test_class_perm_short_circuits(self):
+        self.group.set_perm('pet', BasicAnimal)
+        dogs = cerberus.objects_with_perm(self.user, 'pet', BasicDog.objects.all())
+        self.assertEqual(3, dogs.count())
+    def test_superuser(self):
+        self.user.is_superuser = True
+        dogs = cerberus.objects_with_perm(self.user, 'pet', BasicDog.objects.all())
+        self.assertEqual(3, dogs.count())
+    def test_text_object_pks_cast(self):
+        self.user.set_perm('pet', self.fido)
+        dogs = cerberus.objects_with_perm(self.user, 'pet', BasicDog.objects.all())
+        char_pks = getattr(settings, 'CERBERUS_OBJECT_PK_TYPE', 'char') != 'integer'
+        # integer primary keys are never compared with text object_pks
+        self.assertEqual(char_pks, 'CAST(' in str(dogs.query))
+        self.assertEqual([self.fido.pk], [d.pk for d in dogs])
+
+class HasPermsManyTest(TestCase):
+    def setUp(self):
+        self.dogs = []
+        for name in ('fido', 'rex', 'spot', 'lassie'):
+            dog = BasicDog(name=name, breed="Mutt")
+            dog.save()
+            self.dogs.append(dog)
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.user.groups.add(self.group)
+    def test_many(self):
+        self.user.set_perm('pet', self.dogs[0])
+        self.group.set_perm('pet', self.dogs[2])
+        self.assertEqual({
+            self.dogs[0].pk: True, self.dogs[1].pk: False,
+            self.dogs[2].pk: True, self.dogs[3].pk: False,
+        }, cerberus.has_perms_many(self.user, 'pet', self.dogs))
+        # answers are kept in the user's cache
+        self.assertNumQueries(0, lambda: self.user.has_perm('pet', self.dogs[1]))
+    def test_constant_queries(self):
+        self.user.has_perm('eat', BasicDog)
+        old_chunk_size = cerberus.QUERY_CHUNK_SIZE
+        cerberus.QUERY_CHUNK_SIZE = 2
+        try:
+            self.assertNumQueries(2,
+                lambda: cerberus.has_perms_many(self.user, 'pet', self.dogs))
+        finally:
+            cerberus.QUERY_CHUNK_SIZE = old_chunk_size
+    def test_class_perm(self):
+        self.group.set_perm('pet', BasicAnimal)
+        self.assertEqual(set([True]),
+            set(cerberus.has_perms_many(self.user, 'pet', self.dogs).values()))
+
+class SetPermIdempotentTest(TestCase):
+    def setUp(self):
+        self.fido = BasicAnimal(name="fido")
+        self.fido.save()
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+    def test_set_perm_twice(self):
+        self.user.set_perm('pet', self.fido)
+        self.user.set_perm('pet', self.fido)
+        self.user.set_perm('pet', BasicAnimal)
+        self.user.set_perm('pet', BasicAnimal)
+        self.assertEqual(1, cerberus.models.UserObjectPermission.objects.count())
+        self.assertEqual(1, cerberus.models.UserClassPermission.objects.count())
+        self.user.remove_perm('pet', self.fido)
+        self.user.remove_perm('pet', BasicAnimal)
+        self.assertFalse(self.user.has_perm('pet', self.fido))
+    def test_remove_duplicates_command(self):
+        self.user.set_perm('pet', self.fido)
+        call_command('cerberus_remove_duplicates', verbosity=0)
+        self.assertTrue(self.user.has_perm('pet', self.fido))
+    def test_check_object_pks_command(self):
+        self.user.set_perm('pet', self.fido)
+        call_command('cerberus_check_object_pks', pk_type='integer', delete=True, verbosity=0)
+        self.assertTrue(self.user.has_perm('pet', self.fido))
+
+class RegistryTest(TestCase):
+    def test_class_by_name(self):
+        self.assertEqual(BasicDog, cerberus.get_class_by_name('basicdog'))
+        self.assertEqual(None, cerberus.get_class_by_name('abstractanimal'))
+        self.assertEqual(None, cerberus.get_class_by_name('nosuchmodel'))
+    def test_content_type_lookups_cached(self):
+        cerberus.get_perm_content_type(BasicDog, 'eat')
+        self.assertNumQueries(0, lambda: cerberus.get_perm_content_type(BasicDog, 'eat'))
+        self.assertEqual(ContentType.objects.get_for_model(BasicAnimal),
+            cerberus.get_perm_content_type(BasicDog(), 'eat'))
+    def test_abstract_perms_cloned(self):
+        self.assertEqual(AbstractInheritedDog,
+            cerberus.get_object_perms(AbstractInheritedDog)['pet'].cls)
+        self.assertEqual(AbstractInheritedDog,
+            cerberus.get_class_perms(AbstractInheritedDog)['pet'].cls)
+
+class PlainModel(models.Model):
+    name = models.CharField(max_length=100)
+
+class PlainChild(PlainModel):
+    pass
+
+class RegistrationTest(TestCase):
+    def test_plain_models_skipped(self):
+        self.assertFalse(PlainModel in cerberus.get_classes())
+        self.assertFalse(PlainChild in cerberus.get_classes())
+        self.assertEqual({}, cerberus.get_object_perms(PlainModel))
+        self.assertEqual({}, cerberus.get_class_perms(PlainChild))
+        self.assertEqual([], cerberus.get_ancestor_paths(PlainModel))
+    def test_inheriting_models_registered(self):
+        self.assertTrue(BasicDog in cerberus.get_classes())
+        self.assertTrue(AbstractInheritedDog in cerberus.get_classes())
+    def test_plain_model_perms(self):
+        user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        plain = PlainModel(name="plain")
+        plain.save()
+        self.assertEqual(set(), user.get_perms(plain))
+        self.assertEqual({plain.pk: set()}, cerberus.get_perms_many(user, [plain]))
+        plain.delete()
+    def test_views_not_imported(self):
+        self.assertFalse(hasattr(cerberus, 'permissions_view'))
+        fido = BasicAnimal(name="fido")
+        fido.save()
+        self.assertEqual('/permissions/view/basicanimal/%d/' % fido.pk,
+            fido.get_object_permissions_url())
+
+class SharedCacheTest(TransactionTestCase):
+    """
+    Class permissions and group memberships are shared through
+    Django's cache when CERBERUS_CACHE is set. The cache is bypassed in
+    transactions with uncommitted writes, which TestCase never commits.
+    """
+    def setUp(self):
+        self.old_cache = getattr(settings, 'CERBERUS_CACHE', None)
+        settings.CERBERUS_CACHE = 'default'
+        cerberus.shared_cache.get_shared_cache().clear()
+
+        self.fido = BasicAnimal(name="fido")
+        self.fido.save()
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.user.groups.add(self.group)
+        cerberus.get_perm_content_type(self.fido, 'pet')
+    def tearDown(self):
+        settings.CERBERUS_CACHE = self.old_cache
+    def fresh_user(self):
+        # a new instance has no per-request cache, like in another process
+        return User.objects.get(pk=self.user.pk)
+    def test_shared_between_instances(self):
+        self.group.set_perm('eat', BasicAnimal)
+        user = self.fresh_user()
+        self.assertTrue(user.has_perm('eat', BasicAnimal))
+        user = self.fresh_user()
+        self.assertNumQueries(0, lambda: user.has_perm('eat', BasicAnimal))
+    def test_cache_down(self):
+        # the dummy cache stores nothing, like an unreachable memcached
+        settings.CERBERUS_CACHE = 'dummy://'
+        self.group.set_perm('eat', BasicAnimal)
+        self.assertTrue(self.fresh_user().has_perm('eat', BasicAnimal))
+        self.group.remove_perm('eat', BasicAnimal)
+        self.assertFalse(self.fresh_user().has_perm('eat', BasicAnimal))
+    def test_writes_bump_versions(self):
+        self.assertFalse(self.fresh_user().has_perm('eat', BasicAnimal))
+        self.group.set_perm('eat', BasicAnimal)
+        self.assertTrue(self.fresh_user().has_perm('eat', BasicAnimal))
+        self.group.remove_perm('eat', BasicAnimal)
+        self.assertFalse(self.fresh_user().has_perm('eat', BasicAnimal))
+        self.user.set_perm('pet', BasicAnimal)
+        self.assertTrue(self.fresh_user().has_perm('pet', BasicAnimal))
+    def test_membership_bumps_versions(self):
+        self.group.set_perm('eat', BasicAnimal)
+        self.assertTrue(self.fresh_user().has_perm('eat', BasicAnimal))
+        self.group.user_set.remove(self.user)
+        self.assertFalse(self.fresh_user().has_perm('eat', BasicAnimal))
+        self.group.user_set.add(self.user)
+        self.assertTrue(self.fresh_user().has_perm('eat', BasicAnimal))
+        self.group.user_set.clear()
+        self.assertFalse(self.fresh_user().has_perm('eat', BasicAnimal))
+        self.user.groups.add(self.group)
+        self.assertTrue(self.fresh_user().has_perm('eat', BasicAnimal))
+        self.group.delete()
+        self.assertFalse(self.fresh_user().has_perm('eat', BasicAnimal))
+    def test_caller_transaction(self):
+        from django.db import transaction
+        def write():
+            with transaction.commit_on_success():
+                Group(name='othergroup').save()
+                self.user.set_perm('eat', BasicAnimal)
+                self.assertTrue(self.fresh_user().has_perm('eat', BasicAnimal))
+                raise ValueError
+        self.assertRaises(ValueError, write)
+        # set_perm did not commit the caller's transaction, and nothing
+        # read inside it was cached
+        self.assertFalse(Group.objects.filter(name='othergroup').exists())
+        self.assertFalse(self.fresh_user().has_perm('eat', BasicAnimal))
+
+"""
+Perform tests on permission implication
+"""
+
+class ImpliesDocument(models.Model):
+    class Meta:
+        cerberus = {
+            'object': (
+                ("view", "View", "The user can view this document."),
+                ("edit", "Edit", "The user can edit this document."),
+                ("admin", "Admin", "The user can administer this document."),
+            ),
+            'class': (
+                ("view", "View", "The user can view all documents."),
+                ("edit", "Edit", "The user can edit all documents."),
+            )
+        }
+        cerberus_implies = {
+            'edit': ('view',),
+            'admin': ('edit',),
+        }
+    name = models.CharField(max_length=100)
+
+class ImpliesMemo(ImpliesDocument):
+    pass
+
+class ImpliesTest(TestCase):
+    def setUp(self):
+        self.doc = ImpliesDocument(name="doc")
+        self.doc.save()
+        self.memo = ImpliesMemo(name="memo")
+        self.memo.save()
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.user.groups.add(self.group)
+    def test_closure(self):
+        self.assertEqual(frozenset(['view', 'edit', 'admin']),
+            cerberus.granting_perms[(ImpliesDocument, 'view')])
+        self.assertEqual(frozenset(['admin']),
+            cerberus.granting_perms[(ImpliesDocument, 'admin')])
+        self.assertEqual(frozenset(['view', 'edit', 'admin']),
+            cerberus.granting_perms[(ImpliesMemo, 'view')])
+    def test_object_implication(self):
+        self.user.set_perm('admin', self.doc)
+        self.assertTrue(self.user.has_perm('view', self.doc))
+        self.assertTrue(self.user.has_perm('edit', self.doc))
+        self.assertFalse(self.user.has_perm('view', self.memo))
+        self.group.set_perm('edit', self.memo)
+        self.assertTrue(self.user.has_perm('view', self.memo))
+        self.assertFalse(self.user.has_perm('admin', self.memo))
+        self.assertTrue(self.group.has_perm('view', self.memo))
+    def test_class_implication(self):
+        self.group.set_perm('edit', ImpliesDocument)
+        self.assertTrue(self.user.has_perm('view', ImpliesDocument))
+        self.assertTrue(self.user.has_perm('view', self.memo))
+        self.assertFalse(self.user.has_perm('admin', self.memo))
+    def test_bulk_implication(self):
+        self.user.set_perm('edit', self.doc)
+        self.assertEqual([self.doc.pk], [d.pk for d in cerberus.objects_with_perm(
+            self.user, 'view', ImpliesDocument.objects.all())])
+        self.assertEqual({self.doc.pk: True, self.memo.pk: False},
+            cerberus.has_perms_many(self.user, 'view', [self.doc, self.memo]))
+    def test_single_query(self):
+        self.user.has_perm('view', ImpliesDocument)
+        self.assertNumQueries(1, lambda: self.user.has_perm('view', self.doc))
+
+class PermissionsViewTest(TestCase):
+    """
+    The permission matrix views should cost a constant
+    number of queries regardless of the number of users.
+    """
+    def setUp(self):
+        self.fido = BasicAnimal(name="fido")
+        self.fido.save()
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.group.set_perm('pet', self.fido)
+        self.group.set_perm('eat', BasicAnimal)
+        self.add_users(0, 3)
+    def add_users(self, start, stop):
+        for i in range(start, stop):
+            user = User.objects.create_user('testme%d' % i, 'testing@test.com', 'testingpw')
+            user.save()
+            user.groups.add(self.group)
+            user.set_perm('pet', self.fido)
+            user.set_perm('pet', BasicAnimal)
+    def count_queries(self, url):
+        from django.db import connection
+        from django.conf import settings
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            # queries are reset when the request starts
+            return len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+    def test_class_view_queries(self):
+        url = BasicAnimal.get_class_permissions_url()
+        queries = self.count_queries(url)
+        self.add_users(3, 10)
+        self.assertEqual(queries, self.count_queries(url))
+    def test_object_view_queries(self):
+        url = self.fido.get_object_permissions_url()
+        queries = self.count_queries(url)
+        self.add_users(3, 10)
+        self.assertEqual(queries, self.count_queries(url))
+    def test_object_view_content(self):
+        user = User.objects.create_user('grouponly', 'testing@test.com', 'testingpw')
+        user.groups.add(self.group)
+        response = self.client.get(self.fido.get_object_permissions_url())
+        self.assertContains(response, 'Permission received from group: testgroup')
+        self.assertContains(response, 'User permission on BasicAnimal')
+    def test_pagination(self):
+        old_page_size = getattr(settings, 'CERBERUS_PAGE_SIZE', 50)
+        settings.CERBERUS_PAGE_SIZE = 2
+        try:
+            url = BasicAnimal.get_class_permissions_url()
+            response = self.client.get(url)
+            self.assertEqual(['testme0', 'testme1'],
+                [u.username for u in response.context['users']])
+            response = self.client.get(url, {'page': 2})
+            self.assertEqual(['testme2'],
+                [u.username for u in response.context['users']])
+            self.assertContains(response, 'Page 2 of 2')
+            response = self.client.get(url, {'page': 'bogus'})
+            self.assertEqual(1, response.context['user_page'].number)
+        finally:
+            settings.CERBERUS_PAGE_SIZE = old_page_size
+    def test_search(self):
+        User.objects.create_user('other', 'testing@test.com', 'testingpw')
+        url = self.fido.get_object_permissions_url()
+        response = self.client.get(url, {'q': 'test'})
+        self.assertEqual(['testme0', 'testme1', 'testme2'],
+            [u.username for u in response.context['users']])
+        self.assertEqual(['testgroup'], [g.name for g in response.context['groups']])
+        response = self.client.get(url, {'q': 'oth'})
+        self.assertEqual(['other'], [u.username for u in response.context['users']])
+        self.assertEqual([], list(response.context['groups']))
+    def test_holders(self):
+        User.objects.create_user('nobody', 'testing@test.com', 'testingpw')
+        Group(name='emptygroup').save()
+        for url in (BasicAnimal.get_class_permissions_url(),
+                self.fido.get_object_permissions_edit_url()):
+            response = self.client.get(url, {'holders': '1'})
+            self.assertEqual(['testme0', 'testme1', 'testme2'],
+                [u.username for u in response.context['users']])
+            self.assertEqual(['testgroup'], [g.name for g in response.context['groups']])
+
+class PermissionsEditTest(TestCase):
+    def setUp(self):
+        self.fido = BasicAnimal(name="fido")
+        self.fido.save()
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.users = []
+        for i in range(3):
+            user = User.objects.create_user('testme%d' % i, 'testing@test.com', 'testingpw')
+            user.save()
+            self.users.append(user)
+        self.users[0].set_perm('pet', self.fido)
+        self.users[1].set_perm('pet', self.fido)
+    def test_object_submit(self):
+        u0, u1, u2 = [u.pk for u in self.users]
+        response = self.client.post(self.fido.get_object_permissions_edit_url(), {
+            # unchanged
+            'user_perms_original_%d' % u0: ['pet'],
+            'user_perms_%d' % u0: ['pet'],
+            # removed
+            'user_perms_original_%d' % u1: ['pet'],
+            # added, along with a codename the form does not offer
+            'user_perms_%d' % u2: ['pet', 'bogus'],
+            'group_perms_%d' % self.group.pk: ['pet'],
+            # users which do not exist are ignored
+            'user_perms_999': ['pet'],
+        })
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(set([u0, u2]), set(cerberus.models.UserObjectPermission.objects.values_list(
+            'user', flat=True)))
+        self.assertEqual(['pet'], list(cerberus.models.UserObjectPermission.objects.values_list(
+            'codename', flat=True).distinct()))
+        self.assertTrue(self.group.has_perm('pet', self.fido))
+        users = [User.objects.get(pk=pk) for pk in (u0, u1, u2)]
+        self.assertEqual([True, False, True], [u.has_perm('pet', self.fido) for u in users])
+    def test_class_submit(self):
+        u0 = self.users[0].pk
+        response = self.client.post(BasicAnimal.get_class_permissions_edit_url(), {
+            'user_perms_%d' % u0: ['pet', 'eat'],
+        })
+        self.assertEqual(302, response.status_code)
+        user = User.objects.get(pk=u0)
+        self.assertTrue(user.has_perm('eat', BasicAnimal))
+        self.assertTrue(user.has_perm('pet', BasicAnimal))
+        response = self.client.post(BasicAnimal.get_class_permissions_edit_url(), {
+            'user_perms_original_%d' % u0: ['pet', 'eat'],
+            'user_perms_%d' % u0: ['eat'],
+        })
+        user = User.objects.get(pk=u0)
+        self.assertTrue(user.has_perm('eat', BasicAnimal))
+        self.assertFalse(user.has_perm('pet', BasicAnimal))
+    def test_stale_submit(self):
+        # a form rendered before the permission was granted elsewhere
+        u0 = self.users[0].pk
+        self.client.post(self.fido.get_object_permissions_edit_url(), {
+            'user_perms_%d' % u0: ['pet'],
+        })
+        self.assertEqual(1, cerberus.models.UserObjectPermission.objects.filter(
+            user=u0).count())
+
+class BulkPermTest(TestCase):
+    def setUp(self):
+        self.dogs = []
+        for name in ('fido', 'rex', 'spot'):
+            dog = BasicDog(name=name, breed="Mutt")
+            dog.save()
+            self.dogs.append(dog)
+        self.users = []
+        for i in range(3):
+            user = User.objects.create_user('testme%d' % i, 'testing@test.com', 'testingpw')
+            user.save()
+            self.users.append(user)
+        self.group = Group(name='testgroup')
+        self.group.save()
+    def test_bulk_set_and_remove(self):
+        self.users[0].set_perm('pet', self.dogs[0])
+        principals = self.users + [self.group]
+        cerberus.bulk_set_perm(principals, ['pet'], self.dogs)
+        self.assertEqual(9, cerberus.models.UserObjectPermission.objects.count())
+        self.assertEqual(3, cerberus.models.GroupObjectPermission.objects.count())
+        for user in self.users:
+            user = User.objects.get(pk=user.pk)
+            self.assertTrue(all(cerberus.has_perms_many(user, 'pet', self.dogs).values()))
+        cerberus.bulk_remove_perm(principals, ['pet'], self.dogs[1:])
+        self.assertEqual(3, cerberus.models.UserObjectPermission.objects.count())
+        self.assertEqual(1, cerberus.models.GroupObjectPermission.objects.count())
+        self.assertFalse(self.users[0].has_perm('pet', self.dogs[1]))
+        self.assertTrue(self.users[0].has_perm('pet', self.dogs[0]))
+    def test_bulk_class_perms(self):
+        cerberus.bulk_set_perm(self.users, ['pet', 'eat'], [BasicDog])
+        self.assertEqual(6, cerberus.models.UserClassPermission.objects.count())
+        self.assertTrue(self.users[2].has_perm('eat', BasicDog))
+        cerberus.bulk_remove_perm(self.users, ['eat'], [BasicDog])
+        self.assertFalse(self.users[2].has_perm('eat', BasicDog))
+        self.assertTrue(self.users[2].has_perm('pet', BasicDog))
+    def test_batches(self):
+        old_batch_size = cerberus.BULK_BATCH_SIZE
+        cerberus.BULK_BATCH_SIZE = 2
+        try:
+            cerberus.bulk_set_perm(self.users, ['pet'], self.dogs)
+        finally:
+            cerberus.BULK_BATCH_SIZE = old_batch_size
+        self.assertEqual(9, cerberus.models.UserObjectPermission.objects.count())
+    def test_bulk_insert_queries(self):
+        content_type = cerberus.get_perm_content_type(self.dogs[0], 'pet')
+        objs = [cerberus.models.UserObjectPermission(user=self.users[0],
+            content_type=content_type, object_pk=pk, codename='pet') for pk in range(1000)]
+        # one INSERT per chunk, not per row
+        self.assertNumQueries(3, lambda: cerberus._bulk_insert(
+            cerberus.models.UserObjectPermission, objs))
+        self.assertEqual(1000, cerberus.models.UserObjectPermission.objects.filter(
+            user=self.users[0], codename='pet').count())
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, cerberus.bulk_set_perm, [self.dogs[0]], ['pet'], self.dogs)
+        self.assertRaises(ValueError, cerberus.bulk_set_perm, self.users, ['pet'], [None])
+
+class EffectivePermissionTest(TestCase):
+    """
+    The EffectivePermission table should follow every permission
+    and group membership write when enabled.
+    """
+    def setUp(self):
+        self.old_effective = getattr(settings, 'CERBERUS_EFFECTIVE_PERMISSIONS', False)
+        settings.CERBERUS_EFFECTIVE_PERMISSIONS = True
+
+        self.fido = BasicAnimal(name="fido")
+        self.fido.save()
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.content_type = cerberus.get_perm_content_type(self.fido, 'pet')
+    def tearDown(self):
+        settings.CERBERUS_EFFECTIVE_PERMISSIONS = self.old_effective
+    def test_suspended_per_thread(self):
+        import threading
+        from django.db.models.signals import post_save
+        from cerberus import effective
+        synced = []
+        old_sync = effective.sync
+        effective.sync = lambda user_pks, **kwargs: synced.append(list(user_pks))
+        def write():
+            # sent by hand: the other thread has no test database
+            post_save.send(sender=cerberus.models.UserClassPermission, created=True,
+                instance=cerberus.models.UserClassPermission(user_id=self.user.pk,
+                    content_type_id=self.content_type.pk, codename='eat'))
+        try:
+            with effective.suspended():
+                write()
+                thread = threading.Thread(target=write)
+                thread.start()
+                thread.join()
+        finally:
+            effective.sync = old_sync
+        # only the suspending thread skips its syncs
+        self.assertEqual([[self.user.pk]], synced)
+    def rows(self):
+        return set((user, object_pk if object_pk is None else unicode(object_pk), codename)
+            for (user, object_pk, codename) in cerberus.models.EffectivePermission.objects.values_list(
+            'user', 'object_pk', 'codename'))
+    def test_user_perms(self):
+        self.user.set_perm('pet', self.fido)
+        self.user.set_perm('eat', BasicAnimal)
+        self.assertEqual(set([(self.user.pk, unicode(self.fido.pk), 'pet'),
+            (self.user.pk, None, 'eat')]), self.rows())
+        self.user.remove_perm('pet', self.fido)
+        self.user.remove_perm('eat', BasicAnimal)
+        self.assertEqual(set(), self.rows())
+    def test_group_perms(self):
+        self.group.set_perm('pet', self.fido)
+        self.assertEqual(set(), self.rows())
+        self.user.groups.add(self.group)
+        self.assertEqual(set([(self.user.pk, unicode(self.fido.pk), 'pet')]), self.rows())
+        # a direct grant keeps the row when the group grant goes away
+        self.user.set_perm('pet', self.fido)
+        self.group.remove_perm('pet', self.fido)
+        self.assertEqual(set([(self.user.pk, unicode(self.fido.pk), 'pet')]), self.rows())
+        self.user.remove_perm('pet', self.fido)
+        self.assertEqual(set(), self.rows())
+    def test_membership(self):
+        self.group.set_perm('eat', BasicAnimal)
+        self.group.user_set.add(self.user)
+        self.assertEqual(set([(self.user.pk, None, 'eat')]), self.rows())
+        self.group.user_set.clear()
+        self.assertEqual(set(), self.rows())
+        self.user.groups.add(self.group)
+        self.assertEqual(set([(self.user.pk, None, 'eat')]), self.rows())
+        self.group.delete()
+        self.assertEqual(set(), self.rows())
+    def test_bulk(self):
+        self.user.groups.add(self.group)
+        cerberus.bulk_set_perm([self.group], ['pet'], [self.fido])
+        self.assertEqual(set([(self.user.pk, unicode(self.fido.pk), 'pet')]), self.rows())
+        self.assertEqual([self.fido.pk], [a.pk for a in cerberus.objects_with_perm(
+            self.user, 'pet', BasicAnimal.objects.all())])
+        cerberus.bulk_remove_perm([self.group], ['pet'], [self.fido])
+        self.assertEqual(set(), self.rows())
+    def test_rebuild(self):
+        self.user.groups.add(self.group)
+        self.group.set_perm('pet', self.fido)
+        self.user.set_perm('eat', BasicAnimal)
+        cerberus.models.EffectivePermission.objects.all().delete()
+        call_command('cerberus_rebuild_effective')
+        self.assertEqual(set([(self.user.pk, unicode(self.fido.pk), 'pet'),
+            (self.user.pk, None, 'eat')]), self.rows())
+        self.assertTrue(User.objects.get(pk=self.user.pk).has_perm('pet', self.fido))
+
+class GetPermsTest(TestCase):
+    def setUp(self):
+        self.fido = BasicDog(name="fido", breed="Golden Lab")
+        self.fido.save()
+        self.rex = BasicDog(name="rex", breed="Boxer")
+        self.rex.save()
+        self.doc = ImpliesDocument(name="doc")
+        self.doc.save()
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.user.groups.add(self.group)
+        self.user.has_perm('eat', BasicDog)
+    def test_get_perms(self):
+        self.assertEqual(set(), self.user.get_perms(self.fido))
+        self.group.set_perm('pet', self.fido)
+        self.assertEqual(set(['pet']), self.user.get_perms(self.fido))
+        self.assertEqual(set(), self.user.get_perms(self.rex))
+        self.group.set_perm('eat', BasicAnimal)
+        self.assertEqual(set(['pet', 'eat']), self.user.get_perms(self.fido))
+        self.assertEqual(set(['eat']), self.user.get_perms(BasicDog))
+        self.assertEqual(set(['pet', 'eat']), self.group.get_perms(self.fido))
+        self.assertNumQueries(1, lambda: self.user.get_perms(self.fido))
+    def test_implication(self):
+        self.user.set_perm('admin', self.doc)
+        self.assertEqual(set(['view', 'edit', 'admin']), self.user.get_perms(self.doc))
+        self.assertEqual(set(), self.user.get_perms(ImpliesDocument))
+    def test_superuser(self):
+        self.user.is_superuser = True
+        self.assertEqual(set(['pet', 'eat']), self.user.get_perms(self.fido))
+    def test_get_perms_many(self):
+        self.user.set_perm('pet', self.fido)
+        self.group.set_perm('eat', BasicAnimal)
+        self.user.set_perm('edit', self.doc)
+        self.assertEqual({
+            self.fido.pk: set(['pet', 'eat']),
+            self.rex.pk: set(['eat']),
+        }, self.user.get_perms_many([self.fido, self.rex]))
+        self.assertEqual({self.doc.pk: set(['view', 'edit'])},
+            self.user.get_perms_many([self.doc]))
+        # the class perm cache is warm
+        self.assertNumQueries(1, lambda: self.user.get_perms_many([self.fido, self.rex]))
+        self.assertEqual(set(['eat']), self.group.get_perms_many([self.rex])[self.rex.pk])
+
+class TemplateTagTest(TestCase):
+    def setUp(self):
+        self.dogs = []
+        for name in ('fido', 'rex', 'spot'):
+            dog = BasicDog(name=name, breed="Mutt")
+            dog.save()
+            self.dogs.append(dog)
+
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+        self.user.set_perm('pet', self.dogs[1])
+        self.user.has_perm('eat', BasicDog)
+    def render(self, user):
+        from django.template import Template, Context
+        t = Template('{% load cerberus %}{% cerberus_perms user dogs as perms %}'
+            '{% for dog in dogs %}{% if "pet" in perms|perms_for:dog %}{{ dog.name }};{% endif %}{% endfor %}')
+        return t.render(Context({'user': user, 'dogs': self.dogs}))
+    def test_tag(self):
+        self.assertEqual('rex;', self.render(self.user))
+        self.assertNumQueries(1, lambda: self.render(self.user))
+    def test_anonymous(self):
+        from django.contrib.auth.models import AnonymousUser
+        self.assertEqual('', self.render(AnonymousUser()))
+    def test_syntax(self):
+        from django.template import Template, TemplateSyntaxError
+        self.assertRaises(TemplateSyntaxError, Template,
+            '{% load cerberus %}{% cerberus_perms user dogs perms %}')
+
+class StatsTest(TestCase):
+    def setUp(self):
+        self.fido = BasicDog(name="fido", breed="Mutt")
+        self.fido.save()
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+        self.user.set_perm('pet', self.fido)
+    def test_collect(self):
+        from cerberus import stats
+        with stats.collect() as collected:
+            self.user.has_perm('pet', self.fido)
+            self.user.has_perm('pet', self.fido)
+            self.user.has_perm('eat', BasicDog)
+        self.assertEqual(3, collected.totals['checks'])
+        # class perms are loaded once, the object answer once
+        self.assertEqual(2, collected.totals['queries'])
+        pet = collected.by_perm[('has_perm', 'pet', 'cerberus.basicdog')]
+        self.assertEqual(2, pet['checks'])
+        self.assertEqual(2, pet['cache_misses'])
+        self.assertEqual(2, pet['cache_hits'])
+        self.assertEqual(0, collected.by_perm[('has_perm', 'eat', 'cerberus.basicdog')]['queries'])
+        self.assertTrue('3 permission checks' in collected.summary())
+    def test_collect_across_threads(self):
+        import threading
+        from cerberus import stats
+        with stats.collect() as collected:
+            # another request finishing must not stop this one recording
+            thread = threading.Thread(target=lambda: stats.stop_collecting(
+                stats.start_collecting()))
+            thread.start()
+            thread.join()
+            self.user.has_perm('pet', self.fido)
+        self.assertEqual(1, collected.totals['checks'])
+        self.assertFalse(stats.permission_checked.receivers)
+    def test_group_queries_counted(self):
+        from cerberus import stats
+        group = Group(name='testgroup')
+        group.save()
+        group.set_perm('pet', self.fido)
+        with stats.collect() as collected:
+            cerberus.get_perms_many(group, [self.fido])
+        self.assertEqual(2, collected.totals['queries'])
+    def test_signal(self):
+        from cerberus import stats
+        sent = []
+        def receiver(sender, **kwargs):
+            sent.append((sender, kwargs['codename'], kwargs['result'], kwargs['queries']))
+        stats.permission_checked.connect(receiver)
+        try:
+            cerberus.objects_with_perm(self.user, 'pet', BasicDog.objects.all())
+        finally:
+            stats.permission_checked.disconnect(receiver)
+        self.assertEqual('objects_with_perm', sent[0][0])
+        self.assertEqual('pet', sent[0][1])
+        self.assertEqual(1, sent[0][3])
+        self.user.has_perm('pet', self.fido)
+        self.assertEqual(1, len(sent))
+    def test_middleware(self):
+        from django.http import HttpRequest, HttpResponse
+        from cerberus.middleware import PermissionStatsMiddleware
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            middleware = PermissionStatsMiddleware()
+            request = HttpRequest()
+            middleware.process_request(request)
+            self.user.has_perm('pet', self.fido)
+            response = middleware.process_response(request, HttpResponse())
+        finally:
+            settings.DEBUG = old_debug
+        self.assertEqual('1', response['X-Cerberus-Checks'])
+        self.assertEqual('2', response['X-Cerberus-Queries'])
+
+"""
+Perform tests on mutually exclusive permissions
+"""
+
+class MutexReport(models.Model):
+    class Meta:
+        cerberus = {
+            'object': (
+                ("submit", "Submit", "The user can submit this report."),
+                ("approve", "Approve", "The user can approve this report."),
+                ("read", "Read", "The user can read this report."),
+            ),
+            'class': (
+                ("submit", "Submit", "The user can submit all reports."),
+                ("approve", "Approve", "The user can approve all reports."),
+            )
+        }
+        cerberus_mutex = (
+            ('submit', 'approve'),
+        )
+    name = models.CharField(max_length=100)
+
+class MutexTest(TestCase):
+    def setUp(self):
+        self.report = MutexReport(name="report")
+        self.report.save()
+        self.other = MutexReport(name="other")
+        self.other.save()
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+        self.group = Group(name='testgroup')
+        self.group.save()
+    def test_set_perm(self):
+        self.user.set_perm('submit', self.report)
+        self.user.set_perm('read', self.report)
+        self.user.set_perm('approve', self.other)
+        self.assertRaises(cerberus.PermissionConflict,
+            self.user.set_perm, 'approve', self.report)
+        # class perms hold on every report
+        self.assertRaises(cerberus.PermissionConflict,
+            self.user.set_perm, 'approve', MutexReport)
+        self.assertRaises(cerberus.PermissionConflict,
+            self.user.set_perm, 'submit', MutexReport)
+        # a group without the user as member is a separate principal
+        self.group.set_perm('approve', self.report)
+        self.assertTrue(self.group.has_perm('approve', self.report))
+    def test_class_perm_first(self):
+        self.user.set_perm('approve', MutexReport)
+        self.assertRaises(cerberus.PermissionConflict,
+            self.user.set_perm, 'submit', self.report)
+        self.group.set_perm('submit', MutexReport)
+        self.assertRaises(cerberus.PermissionConflict, self.user.groups.add, self.group)
+    def test_group_perms(self):
+        self.user.groups.add(self.group)
+        self.user.set_perm('submit', self.report)
+        self.assertRaises(cerberus.PermissionConflict,
+            self.group.set_perm, 'approve', self.report)
+        self.assertRaises(cerberus.PermissionConflict,
+            self.group.set_perm, 'approve', MutexReport)
+        self.group.set_perm('approve', self.other)
+        self.assertRaises(cerberus.PermissionConflict,
+            self.user.set_perm, 'submit', self.other)
+        # through another group of a shared member
+        other_group = Group(name='othergroup')
+        other_group.save()
+        other_group.user_set.add(self.user)
+        self.assertRaises(cerberus.PermissionConflict,
+            other_group.set_perm, 'submit', self.other)
+        self.assertRaises(cerberus.PermissionConflict, cerberus.bulk_set_perm,
+            [other_group], ['approve'], [self.report])
+        self.assertEqual(0, cerberus.models.GroupObjectPermission.objects.filter(
+            group=other_group).count())
+    def test_membership(self):
+        self.user.set_perm('submit', self.report)
+        self.group.set_perm('approve', self.report)
+        self.assertRaises(cerberus.PermissionConflict, self.user.groups.add, self.group)
+        self.assertRaises(cerberus.PermissionConflict, self.group.user_set.add, self.user)
+        self.assertEqual([], list(self.user.groups.all()))
+        # groups conflicting with each other
+        self.user.remove_perm('submit', self.report)
+        other_group = Group(name='othergroup')
+        other_group.save()
+        other_group.set_perm('submit', self.report)
+        self.assertRaises(cerberus.PermissionConflict,
+            self.user.groups.add, self.group, other_group)
+        self.user.groups.add(self.group)
+        self.assertTrue(self.user.has_perm('approve', self.report))
+    def test_unrelated_grants_skip_check(self):
+        self.user.set_perm('submit', self.report)
+        self.assertNumQueries(0, lambda: cerberus._exclusive_conflicts('user', True,
+            [(self.user.pk, cerberus.get_perm_content_type(self.report, 'read').pk,
+                self.report.pk, 'read')]))
+    def test_bulk(self):
+        self.user.set_perm('submit', self.report)
+        self.assertRaises(cerberus.PermissionConflict, cerberus.bulk_set_perm,
+            [self.user], ['approve'], [self.report, self.other])
+        # the whole batch is rolled back
+        self.assertEqual(1, cerberus.models.UserObjectPermission.objects.count())
+        self.assertRaises(cerberus.PermissionConflict, cerberus.bulk_set_perm,
+            [self.group], ['approve', 'submit'], [self.other])
+        cerberus.bulk_set_perm([self.user], ['approve'], [self.other])
+        self.assertTrue(self.user.has_perm('approve', self.other))
+    def test_revoke_and_grant(self):
+        self.user.set_perm('submit', self.report)
+        content_type = cerberus.get_perm_content_type(self.report, 'submit')
+        row = (self.user.pk, content_type.pk, self.report.pk, 'submit')
+        swapped = (self.user.pk, content_type.pk, self.report.pk, 'approve')
+        self.assertEqual([], cerberus._exclusive_conflicts('user', True, [swapped], [row]))
+        cerberus._bulk_write_perms('user', True, grants=[swapped], revokes=[row])
+        self.assertEqual(set(['approve']), self.user.get_perms(self.report))
+    def test_edit_view(self):
+        from django.test.client import Client
+        self.user.set_perm('submit', self.report)
+        response = Client().post('/permissions/edit/mutexreport/%s/' % self.report.pk, {
+            'group_perms_%s' % self.group.pk: ['submit'],
+            'user_perms_original_%s' % self.user.pk: ['submit'],
+            'user_perms_%s' % self.user.pk: ['submit', 'approve'],
+        })
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, cerberus.models.GroupObjectPermission.objects.count())
+    def test_audit(self):
+        from StringIO import StringIO
+        output = StringIO()
+        call_command('cerberus_check_mutex', stdout=output)
+        self.assertEqual('0 conflicting permission pairs found.\n', output.getvalue())
+        content_type = cerberus.get_perm_content_type(self.report, 'submit')
+        for codename in ('submit', 'approve'):
+            cerberus.models.UserObjectPermission.objects.create(user=self.user,
+                content_type=content_type, object_pk=self.report.pk, codename=codename)
+        output = StringIO()
+        call_command('cerberus_check_mutex', stdout=output)
+        self.assertEqual(2, len(output.getvalue().splitlines()))
+        self.assertTrue(output.getvalue().endswith('1 conflicting permission pairs found.\n'))
+    def test_audit_across_principals(self):
+        from StringIO import StringIO
+        self.user.groups.add(self.group)
+        content_type = cerberus.get_perm_content_type(self.report, 'submit')
+        cerberus.models.UserObjectPermission.objects.create(user=self.user,
+            content_type=content_type, object_pk=self.report.pk, codename='submit')
+        cerberus.models.GroupClassPermission.objects.create(group=self.group,
+            content_type=cerberus.get_perm_content_type(MutexReport, 'approve'),
+            codename='approve')
+        output = StringIO()
+        call_command('cerberus_check_mutex', stdout=output)
+        self.assertTrue(output.getvalue().endswith('1 conflicting permission pairs found.\n'))
+
+class BulkWriteTransactionTest(TransactionTestCase):
+    def test_writes_share_one_transaction(self):
+        report = MutexReport(name="report")
+        report.save()
+        user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        group = Group(name='testgroup')
+        group.save()
+        content_type = cerberus.get_perm_content_type(report, 'submit')
+        self.assertRaises(cerberus.PermissionConflict, cerberus._bulk_write_many, [
+            ('group', True, [(group.pk, content_type.pk, report.pk, 'read')], []),
+            ('user', True, [(user.pk, content_type.pk, report.pk, 'submit'),
+                (user.pk, content_type.pk, report.pk, 'approve')], []),
+        ])
+        # the group half is rolled back with the user half
+        self.assertEqual(0, cerberus.models.GroupObjectPermission.objects.count())
+    def test_caller_transaction(self):
+        from django.db import transaction
+        report = MutexReport(name="report")
+        report.save()
+        user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        def write():
+            with transaction.commit_on_success():
+                Group(name='testgroup').save()
+                cerberus.bulk_set_perm([user], ['read'], [report])
+                raise ValueError
+        self.assertRaises(ValueError, write)
+        # bulk_set_perm did not commit the caller's transaction
+        self.assertFalse(Group.objects.exists())
+        self.assertEqual(0, cerberus.models.UserObjectPermission.objects.count())
+
+class ExportImportTest(TestCase):
+    def setUp(self):
+        self.fido = BasicDog(name="fido", breed="Mutt")
+        self.fido.save()
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+        self.group = Group(name='testgroup')
+        self.group.save()
+        self.user.set_perm('pet', self.fido)
+        self.user.set_perm('eat', BasicDog)
+        self.group.set_perm('pet', self.fido)
+        self.group.set_perm('eat', BasicAnimal)
+    def rows(self):
+        return [set(model.objects.values_list(*fields)) for (model, fields) in (
+            (cerberus.models.UserObjectPermission, ('user', 'content_type', 'object_pk', 'codename')),
+            (cerberus.models.GroupObjectPermission, ('group', 'content_type', 'object_pk', 'codename')),
+            (cerberus.models.UserClassPermission, ('user', 'content_type', 'codename')),
+            (cerberus.models.GroupClassPermission, ('group', 'content_type', 'codename')))]
+    def round_trip(self, format):
+        import os
+        import tempfile
+        from StringIO import StringIO
+        before = self.rows()
+        (handle, path) = tempfile.mkstemp(suffix='.' + format)
+        os.close(handle)
+        try:
+            call_command('cerberus_export', path, format=format)
+            for model in (cerberus.models.UserObjectPermission, cerberus.models.GroupObjectPermission,
+                    cerberus.models.UserClassPermission, cerberus.models.GroupClassPermission):
+                model.objects.all().delete()
+            call_command('cerberus_import', path, stdout=StringIO())
+            self.assertEqual(before, self.rows())
+            self.assertTrue(self.user.has_perm('pet', self.fido))
+            # existing rows are skipped
+            call_command('cerberus_import', path, upsert=True, stdout=StringIO())
+            self.assertEqual(before, self.rows())
+        finally:
+            os.remove(path)
+    def test_jsonl(self):
+        self.round_trip('jsonl')
+    def test_csv(self):
+        self.round_trip('csv')
+    def import_error(self, lines, format='jsonl'):
+        """
+        Imports lines as a file and returns the error printed when it fails.
+        """
+        import os
+        import sys
+        import tempfile
+        from StringIO import StringIO
+        (handle, path) = tempfile.mkstemp(suffix='.' + format)
+        os.write(handle, ''.join(line + '\n' for line in lines))
+        os.close(handle)
+        old_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(SystemExit, call_command, 'cerberus_import', path)
+            return sys.stderr.getvalue()
+        finally:
+            sys.stderr = old_stderr
+            os.remove(path)
+    def test_invalid_codename(self):
+        error = self.import_error(['{"principal": "user", "principal_pk": %d, "content_type": "cerberus.basicanimal", '
+            '"object_pk": null, "codename": "fly"}' % self.user.pk])
+        self.assertTrue("'fly' is not a registered class permission" in error)
+    def test_line_numbers(self):
+        row = '{"principal": "user", "principal_pk": %d, "content_type": "cerberus.basicanimal", ' \
+            '"object_pk": null, "codename": "eat"}' % self.user.pk
+        error = self.import_error([row, '', '{"principal": "user"'])
+        self.assertTrue("Line 3: invalid row" in error)
+        error = self.import_error(['principal,principal_pk,content_type,object_pk,codename',
+            'user,%d,cerberus.basicanimal,,eat' % self.user.pk,
+            'user,%d,cerberus.basicanimal,,fly' % self.user.pk], format='csv')
+        self.assertTrue("Line 3: 'fly'" in error)
+    def test_inherited_content_type(self):
+        error = self.import_error(['{"principal": "user", "principal_pk": %d, '
+            '"content_type": "cerberus.basicdog", "object_pk": "%s", "codename": "pet"}' % (
+            self.user.pk, self.fido.pk)])
+        self.assertTrue("'pet' is stored under cerberus.basicanimal, not cerberus.basicdog" in error)
+    def test_mutex(self):
+        report = MutexReport()
+        report.save()
+        self.user.set_perm('submit', report)
+        row = '{"principal": "user", "principal_pk": %d, "content_type": "cerberus.mutexreport", ' \
+            '"object_pk": "%s", "codename": "%s"}'
+        error = self.import_error([row % (self.user.pk, report.pk, 'read'),
+            row % (self.user.pk, report.pk, 'approve')])
+        self.assertTrue("Line 2: " in error)
+        self.assertFalse(self.user.has_perm('approve', report))
+        self.assertFalse(self.user.has_perm('read', report))
+    def test_duplicate(self):
+        row = '{"principal": "%s", "principal_pk": %d, "content_type": "cerberus.basicanimal", ' \
+            '"object_pk": null, "codename": "%s"}'
+        error = self.import_error([row % ('user', self.user.pk, 'pet'), row % ('group', self.group.pk, 'eat')])
+        self.assertTrue("Line 2: " in error)
+
+class ClassPermAnimal(models.Model):
+    class Meta:
+        cerberus = {
+            'class': (
+                ("feed", "Feed", "The user can feed all animals."),
+            )
+        }
+
+class OrphanTest(TestCase):
+    def setUp(self):
+        self.dogs = []
+        for name in ('fido', 'rex', 'spot'):
+            dog = BasicDog(name=name, breed="Mutt")
+            dog.save()
+            self.dogs.append(dog)
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+        self.group = Group(name='testgroup')
+        self.group.save()
+        cerberus.bulk_set_perm([self.user, self.group], ['pet'], self.dogs)
+        self.user.set_perm('eat', BasicDog)
+    def count(self):
+        return (cerberus.models.UserObjectPermission.objects.count() +
+            cerberus.models.GroupObjectPermission.objects.count())
+    def test_delete(self):
+        self.assertTrue(self.user.has_perm('pet', self.dogs[0]))
+        self.dogs[0].delete()
+        self.assertEqual(4, self.count())
+        self.assertEqual(1, cerberus.models.UserClassPermission.objects.count())
+        self.assertFalse(self.user.has_perm('pet', self.dogs[0]))
+    def test_deferred_cleanup(self):
+        with cerberus.deferred_perm_cleanup():
+            BasicDog.objects.filter(pk__in=[dog.pk for dog in self.dogs[:2]]).delete()
+            self.assertEqual(6, self.count())
+        self.assertEqual(2, self.count())
+    def record_cleanups(self):
+        cleanups = []
+        old_delete = cerberus._delete_object_perms
+        cerberus._delete_object_perms = lambda content_type_pks, object_pks: \
+            cleanups.append(list(object_pks))
+        self.addCleanup(setattr, cerberus, '_delete_object_perms', old_delete)
+        return cleanups
+    def test_deferred_cleanup_exception(self):
+        def delete():
+            with cerberus.deferred_perm_cleanup():
+                self.dogs[0].delete()
+                raise ValueError
+        self.assertRaises(ValueError, delete)
+        self.assertEqual(4, self.count())
+    def test_deferred_cleanup_per_thread(self):
+        import threading
+        from django.db.models.signals import post_delete
+        cleanups = self.record_cleanups()
+        # sent by hand: the other thread has no test database
+        thread = threading.Thread(target=lambda: post_delete.send(sender=BasicDog,
+            instance=self.dogs[0]))
+        with cerberus.deferred_perm_cleanup():
+            thread.start()
+            thread.join()
+            self.assertEqual([[self.dogs[0].pk]], cleanups)
+        self.assertEqual([[self.dogs[0].pk]], cleanups)
+    def test_class_perms_only(self):
+        cleanups = self.record_cleanups()
+        animal = ClassPermAnimal()
+        animal.save()
+        animal.delete()
+        self.assertEqual([], cleanups)
+    def test_remove_orphans(self):
+        content_type = cerberus.get_perm_content_type(self.dogs[0], 'pet')
+        stale = ContentType.objects.create(name='gone', app_label='cerberus', model='gone')
+        for (content_type, object_pk) in ((content_type, 999), (content_type, 998), (stale, 1)):
+            cerberus.models.UserObjectPermission.objects.create(user=self.user,
+                content_type=content_type, object_pk=object_pk, codename='pet')
+        call_command('cerberus_remove_orphans', dry_run=True, verbosity=0)
+        self.assertEqual(9, self.count())
+        call_command('cerberus_remove_orphans', verbosity=0)
+        self.assertEqual(6, self.count())
+
+class HierFolder(models.Model):
+    class Meta:
+        cerberus = {
+            'object': (
+                ("read", "Read", "Can read everything in this folder."),
+                ("share", "Share", "Can share this folder."),
+            ),
+            'parent': 'parent',
+        }
+    name = models.CharField(max_length=100)
+    parent = models.ForeignKey('self', null=True, blank=True)
+
+class HierDocument(models.Model):
+    class Meta:
+        cerberus = {
+            'object': (
+                ("read", "Read", "Can read this document."),
+                ("edit", "Edit", "Can edit this document."),
+            ),
+            'parent': 'folder',
+        }
+    name = models.CharField(max_length=100)
+    folder = models.ForeignKey(HierFolder)
+
+class HierarchyTest(TestCase):
+    def setUp(self):
+        self.root = HierFolder(name="root")
+        self.root.save()
+        self.sub = HierFolder(name="sub", parent=self.root)
+        self.sub.save()
+        self.other = HierFolder(name="other")
+        self.other.save()
+        self.doc = HierDocument(name="doc", folder=self.sub)
+        self.doc.save()
+        self.stray = HierDocument(name="stray", folder=self.other)
+        self.stray.save()
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        self.user.save()
+        self.group = Group(name='testgroup')
+        self.group.save()
+    def test_ancestor_paths(self):
+        self.assertEqual([('folder', HierFolder), ('folder__parent', HierFolder),
+            ('folder__parent__parent', HierFolder)],
+            cerberus.get_ancestor_paths(HierDocument)[:3])
+        self.assertEqual(10, len(cerberus.get_ancestor_paths(HierDocument)))
+        self.assertEqual([], cerberus.get_ancestor_paths(BasicAnimal))
+    def test_has_perm(self):
+        self.user.set_perm('read', self.root)
+        self.assertTrue(self.user.has_perm('read', self.sub))
+        self.assertTrue(self.user.has_perm('read', self.doc))
+        self.assertFalse(self.user.has_perm('read', self.stray))
+        self.assertFalse(self.user.has_perm('read', self.other))
+        # only perms the document registers are inherited
+        self.user.set_perm('share', self.root)
+        self.assertFalse(self.user.has_perm('edit', self.doc))
+        self.user.remove_perm('read', self.root)
+        self.assertFalse(self.user.has_perm('read', self.doc))
+    def test_has_perm_queries(self):
+        self.user.set_perm('read', self.sub)
+        self.user.has_perm('read', self.stray)
+        # one query for the ancestors' pks, one for the permission rows
+        self.assertNumQueries(2, lambda: self.user.has_perm('read', self.doc))
+    def test_objects_with_perm(self):
+        self.user.set_perm('read', self.root)
+        self.assertEqual([self.doc.pk], list(cerberus.objects_with_perm(
+            self.user, 'read', HierDocument.objects.all()).values_list('pk', flat=True)))
+        self.assertEqual(set([self.root.pk, self.sub.pk]), set(cerberus.objects_with_perm(
+            self.user, 'read', HierFolder.objects.all()).values_list('pk', flat=True)))
+        self.user.set_perm('read', self.stray)
+        self.assertEqual(2, cerberus.objects_with_perm(
+            self.user, 'read', HierDocument.objects.all()).count())
+    def test_has_perms_many(self):
+        self.user.set_perm('read', self.sub)
+        self.assertEqual({self.doc.pk: True, self.stray.pk: False},
+            cerberus.has_perms_many(self.user, 'read', [self.doc, self.stray]))
+    def test_get_perms(self):
+        self.user.set_perm('read', self.root)
+        self.user.set_perm('share', self.root)
+        self.user.set_perm('edit', self.doc)
+        self.assertEqual(set(['read', 'edit']), self.user.get_perms(self.doc))
+        self.assertEqual(set(), self.user.get_perms(self.stray))
+        self.assertEqual(set(['read', 'share']), self.user.get_perms(self.sub))
+        self.assertEqual({self.doc.pk: set(['read', 'edit']), self.stray.pk: set()},
+            cerberus.get_perms_many(self.user, [self.doc, self.stray]))
+    def test_group(self):
+        self.user.groups.add(self.group)
+        self.group.set_perm('read', self.other)
+        self.assertTrue(self.group.has_perm('read', self.stray))
+        self.assertFalse(self.group.has_perm('read', self.doc))
+        self.assertTrue(self.user.has_perm('read', self.stray))
+
+class ManyGroupsTest(TestCase):
+    """
+    Users in hundreds of groups, e.g. service accounts, must not push
+    queries past the database's parameter limit.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('testme', 'testing@test.com', 'testingpw')
+        cerberus._bulk_insert(Group, [Group(name='group%d' % i) for i in range(250)])
+        self.groups = list(Group.objects.all())
+        cerberus._bulk_insert(User.groups.through, [User.groups.through(
+            user_id=self.user.pk, group_id=group.pk) for group in self.groups])
+        cerberus._bulk_insert(BasicAnimal, [BasicAnimal(name='animal%d' % i)
+            for i in range(500)])
+        self.animals = list(BasicAnimal.objects.all())
+        cerberus.invalidate_perm_cache()
+        self.user.set_perm('pet', self.animals[0])
+        self.groups[-1].set_perm('pet', self.animals[-1])
+    def max_params(self, func):
+        """
+        Returns func's result and the most parameters one of its queries
+        passed, as SQLite builds with higher limits than 999 accept more.
+        """
+        from django.db import connection
+        from django.db.backends import util
+        counts = [0]
+        execute = util.CursorDebugWrapper.execute
+        def counting_execute(cursor, sql, params=()):
+            counts.append(len(params))
+            return execute(cursor, sql, params)
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        util.CursorDebugWrapper.execute = counting_execute
+        try:
+            result = func()
+        finally:
+            util.CursorDebugWrapper.execute = execute
+            connection.use_debug_cursor = old_debug_cursor
+        return (result, max(counts))
+    def test_has_perms_many(self):
+        (result, params) = self.max_params(lambda: cerberus.has_perms_many(
+            self.user, 'pet', self.animals))
+        self.assertTrue(params <= cerberus.MAX_QUERY_PARAMS)
+        self.assertEqual(set([self.animals[0].pk, self.animals[-1].pk]),
+            set(pk for (pk, granted) in result.items() if granted))
+    def test_get_perms_many(self):
+        (result, params) = self.max_params(lambda: cerberus.get_perms_many(
+            self.user, self.animals))
+        self.assertTrue(params <= cerberus.MAX_QUERY_PARAMS)
+        self.assertEqual(set(['pet']), result[self.animals[-1].pk])
+        self.assertEqual(set(), result[self.animals[1].pk])
+    def test_objects_with_perm_through_ancestors(self):
+        folder = HierFolder(name="folder")
+        folder.save()
+        doc = HierDocument(name="doc", folder=folder)
+        doc.save()
+        self.groups[-1].set_perm('read', folder)
+        (result, params) = self.max_params(lambda: list(cerberus.objects_with_perm(
+            self.user, 'read', HierDocument.objects.all()).values_list('pk', flat=True)))
+        self.assertTrue(params <= cerberus.MAX_QUERY_PARAMS)
+        self.assertEqual([doc.pk], result)
@@ -1,8 +1,13 @@
 from django.shortcuts import render_to_response
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
+from django.http import HttpResponseBadRequest
 from django.template import RequestContext
 from django.db import models
+from django.db.models import Q
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.core.paginator import InvalidPage
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
 
@@ -14,10 +19,8 @@ from cerberus.models import UserClassPermission
 from cerberus.models import GroupClassPermission
 
 def __get_cls_obj_and_content_type(clsname, obj_pk):
-    (cls, obj) = (None, None)
-    for cerb_cls in cerberus.get_classes():
-        if cerb_cls.__name__.lower() == clsname:
-            cls = cerb_cls
+    obj = None
+    cls = cerberus.get_class_by_name(clsname)
     if cls is None:
         raise Exception("Invalid class name.")
     content_type = cerberus.get_class_content_type(cls)
@@ -25,56 +28,80 @@ def __get_cls_obj_and_content_type(clsname, obj_pk):
         obj = cls.objects.get(pk=obj_pk)
     return (cls, obj, content_type)
 
-def __get_users_and_groups(cls, obj=None):
-    users = User.objects.all()
-    groups = Group.objects.all()
+def __codenames_by_pk(values_list):
+    """
+    Turns (pk, codename) rows into a dict of pk -> set of codenames.
+    """
+    codenames = {}
+    for (pk, codename) in values_list:
+        codenames.setdefault(pk, set()).add(codename)
+    return codenames
+
+def __get_users_and_groups(cls, obj, users, groups):
+    """
+    Builds the user & group permission matrix for the provided users
+    and groups, usually the current page. Every table involved is read
+    with one bulk query and the matrix is assembled in python, so the
+    number of queries does not depend on the number of users.
+    """
+    user_pks = [u.pk for u in users]
+    groups_by_pk = dict((g.pk, g) for g in groups)
+    memberships = list(User.groups.through.objects.filter(
+        user__in=user_pks).values_list('user', 'group'))
+    # groups users on this page belong to which are not on this page
+    missing = set(group_id for (user_id, group_id) in memberships) - set(groups_by_pk)
+    member_groups = list(Group.objects.filter(pk__in=missing)) if missing else []
+    groups_by_pk.update((g.pk, g) for g in member_groups)
+    user_groups = {}
+    for (user_id, group_id) in memberships:
+        user_groups.setdefault(user_id, []).append(groups_by_pk[group_id])
+    for u in users:
+        u.group_list = user_groups.get(u.pk, [])
+    all_groups = groups_by_pk.values()
     content_type = cerberus.get_class_content_type(cls)
     class_perms = cerberus.get_class_perms(cls)
-    ucp = UserClassPermission.objects.filter(content_type=content_type)
-    gcp = GroupClassPermission.objects.filter(content_type=content_type)
-    group_class_perms = {}
-    for g in groups:
-        group_class_perms[g] = set()
-        for perm in gcp.filter(group=g).values('codename'):
-            group_class_perms[g].add(perm['codename'])
-        g.class_perms = group_class_perms[g]
+    ucp = __codenames_by_pk(UserClassPermission.objects.filter(
+        content_type=content_type, user__in=user_pks).values_list('user', 'codename'))
+    gcp = __codenames_by_pk(GroupClassPermission.objects.filter(
+        content_type=content_type, group__in=groups_by_pk.keys()).values_list('group', 'codename'))
+    for g in all_groups:
+        g.class_perms = gcp.get(g.pk, set())
     for u in users:
         u.class_perms = {}
-        u.class_perms_user_only = set()
-        for perm in ucp.filter(user=u).values('codename'):
-            u.class_perms[perm['codename']] = 'User permission on %s' % cls.__name__
-            u.class_perms_user_only.add(perm['codename'])
+        u.class_perms_user_only = ucp.get(u.pk, set())
+        for perm in u.class_perms_user_only:
+            u.class_perms[perm] = 'User permission on %s' % cls.__name__
         perms_set = set(u.class_perms)
-        for g in u.groups.all():
-            for nperm in (group_class_perms[g] - perms_set):
+        for g in u.group_list:
+            for nperm in (g.class_perms - perms_set):
                 u.class_perms[nperm] = 'Permission received from group: %s' % unicode(g)
         if u.is_superuser:
             for cls_perm in class_perms:
                 u.class_perms[cls_perm] = 'User receives permission as superuser.'
     if obj is None:
         return (users, groups)
-    uop = UserObjectPermission.objects.filter(content_type=content_type, object_pk=obj.pk)
-    gop = GroupObjectPermission.objects.filter(content_type=content_type, object_pk=obj.pk)
+    uop = __codenames_by_pk(UserObjectPermission.objects.filter(
+        content_type=content_type, object_pk=obj.pk,
+        user__in=user_pks).values_list('user', 'codename'))
+    gop = __codenames_by_pk(GroupObjectPermission.objects.filter(
+        content_type=content_type, object_pk=obj.pk,
+        group__in=groups_by_pk.keys()).values_list('group', 'codename'))
     object_perms = cerberus.get_object_perms(cls)
-    group_object_perms = {}
-    for g in groups:
+    for g in all_groups:
         # handle regular GroupObjectPermissions
-        group_object_perms[g] = set()
-        for perm in gop.filter(group=g).values('codename'):
-            group_object_perms[g].add(perm['codename'])
-        g.object_perms = group_object_perms[g]
-        g.object_perms_group_only = group_object_perms[g]
+        g.object_perms = gop.get(g.pk, set())
+        g.object_perms_group_only = g.object_perms
         # handle group object perms inherited from class perms
         # TODO
     for u in users:
         # handle regular UserObjectPermissions
-        u.object_perms_user_only = set()
+        u.object_perms_user_only = uop.get(u.pk, set())
         u.object_perms = {}
-        for perm in uop.filter(user=u).values('codename'):
-            u.object_perms_user_only.add(perm['codename'])
-            u.object_perms[perm['codename']] = 'User permission on %s %s' % (cls.__name__, unicode(obj))
-        for g in u.groups.all():
-            for nperm in (group_object_perms[g] - perms_set):
+        for perm in u.object_perms_user_only:
+            u.object_perms[perm] = 'User permission on %s %s' % (cls.__name__, unicode(obj))
+        perms_set = set(u.object_perms)
+        for g in u.group_list:
+            for nperm in (g.object_perms - perms_set):
                 u.object_perms[nperm] = 'Permission received from group: %s' % unicode(g)
         if u.is_superuser:
             for obj_perm in object_perms:
@@ -85,7 +112,8 @@ def __get_users_and_groups(cls, obj=None):
 
 def __get_add_rm_perms(request, group_or_user, pk, add_or_rm):
     """
-
+    Returns the perms checked ('add') or unchecked ('rm') for the user
+    or group with the provided pk.
     """
     perms = request.POST.getlist(group_or_user + '_perms_' + unicode(pk))
     perms_original = request.POST.getlist(group_or_user + '_perms_original_' + unicode(pk))
@@ -96,59 +124,141 @@ def __get_add_rm_perms(request, group_or_user, pk, add_or_rm):
     else:
         return perms_original - perms
 
+def __get_posted_pks(request, group_or_user):
+    """
+    Returns the pks of every user or group with fields in the POST.
+    """
+    pks = set()
+    for key in request.POST:
+        for prefix in (group_or_user + '_perms_original_', group_or_user + '_perms_'):
+            if key.startswith(prefix):
+                if key[len(prefix):].isdigit():
+                    pks.add(int(key[len(prefix):]))
+                break
+    return pks
+
+def __get_posted_changes(request, group_or_user, model, obj_or_cls, valid_perms):
+    """
+    Returns the (grants, revokes) rows for _bulk_write_perms posted for
+    existing users or groups. Codenames which are not valid for the
+    form are ignored.
+    """
+    pks = __get_posted_pks(request, group_or_user)
+    if pks:
+        pks = model.objects.filter(pk__in=pks).values_list('pk', flat=True)
+    object_pk = None
+    if isinstance(obj_or_cls, models.Model):
+        object_pk = obj_or_cls.pk
+    (grants, revokes) = ([], [])
+    for pk in pks:
+        for (add_or_rm, rows) in (('add', grants), ('rm', revokes)):
+            for perm in __get_add_rm_perms(request, group_or_user, pk, add_or_rm):
+                if perm in valid_perms:
+                    content_type = cerberus.get_perm_content_type(obj_or_cls, perm)
+                    rows.append((pk, content_type.pk, object_pk, perm))
+    return (grants, revokes)
+
 def __handle_form_submit(request, cls, obj, content_type):
-    obj_or_cls = None
+    """
+    Applies the submitted changes for the users and groups in the POST
+    in one transaction, with a fixed number of queries per table.
+    """
     if obj is None:
-        obj_or_cls = cls
+        (obj_or_cls, valid_perms) = (cls, cerberus.get_class_perms(cls))
     else:
-        obj_or_cls = obj
-    for group in Group.objects.all():
-        for perm in __get_add_rm_perms(request, 'group', group.pk, 'add'):
-            group.set_perm(perm, obj_or_cls)
-        for perm in __get_add_rm_perms(request, 'group', group.pk, 'rm'):
-            group.remove_perm(perm, obj_or_cls)
-    for user in User.objects.all():
-        for perm in __get_add_rm_perms(request, 'user', user.pk, 'add'):
-            user.set_perm(perm, obj_or_cls)
-        for perm in __get_add_rm_perms(request, 'user', user.pk, 'rm'):
-            user.remove_perm(perm, obj_or_cls)
+        (obj_or_cls, valid_perms) = (obj, cerberus.get_object_perms(cls))
+    changes = []
+    for (group_or_user, model) in (('group', Group), ('user', User)):
+        (grants, revokes) = __get_posted_changes(request, group_or_user, model,
+            obj_or_cls, valid_perms)
+        # check both tables before writing either
+        conflicts = cerberus._exclusive_conflicts(group_or_user, obj is not None,
+            grants, revokes)
+        if conflicts:
+            return HttpResponseBadRequest(unicode(cerberus.PermissionConflict(conflicts)))
+        changes.append((group_or_user, obj is not None, grants, revokes))
+    try:
+        # one transaction for groups and users alike
+        cerberus._bulk_write_many(changes)
+    except cerberus.PermissionConflict, e:
+        return HttpResponseBadRequest(unicode(e))
     if obj is None:
         return HttpResponseRedirect(cls.get_class_permissions_url())
     else:
         return HttpResponseRedirect(obj.get_object_permissions_url())
 
+def __get_page(request, queryset, param):
+    paginator = Paginator(queryset, getattr(settings, 'CERBERUS_PAGE_SIZE', 50))
+    try:
+        return paginator.page(int(request.GET.get(param, 1)))
+    except (ValueError, InvalidPage):
+        return paginator.page(1)
+
+def __get_principal_pages(request, cls, obj, content_type):
+    """
+    Returns the current pages of users and groups, narrowed down by the
+    search parameters: q matches the start of usernames and group names,
+    holders limits both to principals holding a permission, directly,
+    through a group or as superuser.
+    """
+    users = User.objects.order_by('username')
+    groups = Group.objects.order_by('name')
+    query = request.GET.get('q', '')
+    holders = bool(request.GET.get('holders'))
+    if query:
+        users = users.filter(username__startswith=query)
+        groups = groups.filter(name__startswith=query)
+    if holders:
+        if obj is None:
+            user_perms = UserClassPermission.objects.filter(content_type=content_type)
+            group_perms = GroupClassPermission.objects.filter(content_type=content_type)
+        else:
+            user_perms = UserObjectPermission.objects.filter(
+                content_type=content_type, object_pk=obj.pk)
+            group_perms = GroupObjectPermission.objects.filter(
+                content_type=content_type, object_pk=obj.pk)
+        users = users.filter(Q(pk__in=user_perms.values('user')) |
+            Q(groups__in=group_perms.values('group')) |
+            Q(is_superuser=True)).distinct()
+        groups = groups.filter(pk__in=group_perms.values('group'))
+    user_page = __get_page(request, users, 'page')
+    group_page = __get_page(request, groups, 'group_page')
+    return (user_page, group_page, {
+        'user_page': user_page, 'group_page': group_page,
+        'query': query, 'holders': holders,
+    })
+
+def __render_matrix(request, template, cls, obj, content_type):
+    (user_page, group_page, context) = __get_principal_pages(request, cls, obj, content_type)
+    (users, groups) = __get_users_and_groups(cls, obj,
+        list(user_page.object_list), list(group_page.object_list))
+    context.update({
+        'class_perms': cerberus.get_class_perms(cls),
+        'users': users, 'groups': groups,
+        'clsname': cls.__name__,
+    })
+    if obj is None:
+        context['class'] = cls
+    else:
+        context['object_perms'] = cerberus.get_object_perms(cls)
+        context['object'] = obj
+    return render_to_response(template, context,
+            context_instance=RequestContext(request))
+
 def permissions_edit(request, clsname, obj_pk=None):
     (cls, obj, content_type) = __get_cls_obj_and_content_type(clsname, obj_pk)
     if request.method == 'POST':
         return __handle_form_submit(request, cls, obj, content_type)
-    (users, groups) = __get_users_and_groups(cls, obj)
-    class_perms = cerberus.get_class_perms(cls)
-    object_perms = cerberus.get_object_perms(cls)
     if obj is None:
-        return render_to_response('cerberus/class_perms_edit.html',
-                {'class_perms': class_perms,
-                    'users': users, 'groups': groups,
-                    'clsname': cls.__name__, 'class': cls},
-                context_instance=RequestContext(request))
-    return render_to_response('cerberus/object_perms_edit.html',
-            {'class_perms': class_perms, 'object_perms': object_perms,
-                'users': users, 'groups': groups, 
-                'clsname': cls.__name__, 'object': obj},
-            context_instance=RequestContext(request))
+        return __render_matrix(request, 'cerberus/class_perms_edit.html',
+                cls, obj, content_type)
+    return __render_matrix(request, 'cerberus/object_perms_edit.html',
+            cls, obj, content_type)
 
 def permissions_view(request, clsname, obj_pk=None):
     (cls, obj, content_type) = __get_cls_obj_and_content_type(clsname, obj_pk)
-    (users, groups) = __get_users_and_groups(cls, obj)
-    class_perms = cerberus.get_class_perms(cls)
-    object_perms = cerberus.get_object_perms(cls)
     if obj is None:
-        return render_to_response('cerberus/class_perms_view.html',
-                {'class_perms': class_perms,
-                    'users': users, 'groups': groups,
-                    'clsname': cls.__name__, 'class': cls},
-                context_instance=RequestContext(request))
-    return render_to_response('cerberus/object_perms_view.html',
-            {'class_perms': class_perms, 'object_perms': object_perms,
-                'users': users, 'groups': groups, 
-                'clsname': cls.__name__, 'object': obj},
-            context_instance=RequestContext(request))
+        return __render_matrix(request, 'cerberus/class_perms_view.html',
+                cls, obj, content_type)
+    return __render_matrix(request, 'cerberus/object_perms_view.html',
+            cls, obj, content_type)
@@ -0,0 +1,156 @@
+import math
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.db import reset_queries
+from django.test.client import RequestFactory
+from django.utils import simplejson
+
+import cerberus
+from cerberus import effective
+from cerberus.views import permissions_view
+from exampleapp.models import Animal
+
+class Command(NoArgsCommand):
+    help = ("Seeds a throwaway test database with users, groups, animals and "
+            "permissions, then times has_perm, get_perms, objects_with_perm "
+            "and permissions_view. Runs are reproducible for a given --seed.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--users', type='int', dest='users', default=200),
+        make_option('--groups', type='int', dest='groups', default=20),
+        make_option('--objects', type='int', dest='objects', default=500),
+        make_option('--groups-per-user', type='int', dest='groups_per_user', default=2),
+        make_option('--user-density', type='float', dest='user_density', default=0.02,
+            help="Chance of a user holding each object perm on each animal."),
+        make_option('--group-density', type='float', dest='group_density', default=0.05,
+            help="Chance of a group holding each object perm on each animal."),
+        make_option('--class-density', type='float', dest='class_density', default=0.1,
+            help="Chance of a user or group holding each class perm."),
+        make_option('--iterations', type='int', dest='iterations', default=200),
+        make_option('--seed', type='int', dest='seed', default=0),
+        make_option('--json', action='store_true', dest='json', default=False,
+            help="Print the results as JSON, e.g. to compare against budgets."),
+        make_option('--current-db', action='store_false', dest='create_db', default=True,
+            help="Seed the current database instead of a throwaway test database, "
+                "e.g. one the test runner created. Never use it on real data."),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        old_name = connection.settings_dict['NAME']
+        old_debug = settings.DEBUG
+        if options['create_db']:
+            connection.creation.create_test_db(verbosity=0)
+        # DEBUG makes the connection record queries so they can be counted
+        settings.DEBUG = True
+        try:
+            self.random = random.Random(options['seed'])
+            start = time.time()
+            self.seed(options)
+            if verbosity > 0 and not options['json']:
+                self.stdout.write("Seeded in %.2fs\n" % (time.time() - start))
+            results = self.run(options)
+        finally:
+            settings.DEBUG = old_debug
+            if options['create_db']:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        if options['json']:
+            self.stdout.write(simplejson.dumps(dict(results), indent=2) + "\n")
+            return
+        self.stdout.write("%-24s %10s %10s %10s\n" % ('', 'mean ms', 'p95 ms', 'queries'))
+        for (name, result) in results:
+            self.stdout.write("%-24s %10.3f %10.3f %10.2f\n" % (
+                name, result['mean_ms'], result['p95_ms'], result['queries']))
+
+    def seed(self, options):
+        cerberus._bulk_insert(User, [User(username='bench%d' % i)
+            for i in range(options['users'])])
+        cerberus._bulk_insert(Group, [Group(name='bench%d' % i)
+            for i in range(options['groups'])])
+        cerberus._bulk_insert(Animal, [Animal(name='animal%d' % i)
+            for i in range(options['objects'])])
+        self.user_pks = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        group_pks = list(Group.objects.order_by('pk').values_list('pk', flat=True))
+        self.animal_pks = list(Animal.objects.order_by('pk').values_list('pk', flat=True))
+        with effective.suspended():
+            memberships = []
+            for user_pk in self.user_pks:
+                for group_pk in self.random.sample(group_pks,
+                        min(options['groups_per_user'], len(group_pks))):
+                    memberships.append(User.groups.through(user_id=user_pk, group_id=group_pk))
+            cerberus._bulk_insert(User.groups.through, memberships)
+        content_type = cerberus.get_class_content_type(Animal)
+        object_perms = sorted(cerberus.get_object_perms(Animal))
+        class_perms = sorted(cerberus.get_class_perms(Animal))
+        for (principal_field, pks, density) in (
+                ('user', self.user_pks, options['user_density']),
+                ('group', group_pks, options['group_density'])):
+            cerberus._bulk_write_perms(principal_field, True, grants=[
+                (pk, content_type.pk, animal_pk, codename)
+                for pk in pks for animal_pk in self.animal_pks for codename in object_perms
+                if self.random.random() < density])
+            cerberus._bulk_write_perms(principal_field, False, grants=[
+                (pk, content_type.pk, None, codename)
+                for pk in pks for codename in class_perms
+                if self.random.random() < options['class_density']])
+
+    def measure(self, iterations, setup, func):
+        timings = []
+        queries = 0
+        for i in range(iterations):
+            args = setup()
+            reset_queries()
+            start = time.time()
+            func(*args)
+            timings.append(time.time() - start)
+            queries += len(connection.queries)
+        timings.sort()
+        return {
+            'mean_ms': 1000 * sum(timings) / len(timings),
+            'p95_ms': 1000 * timings[int(math.ceil(len(timings) * 0.95)) - 1],
+            'queries': float(queries) / iterations,
+        }
+
+    def run(self, options):
+        iterations = options['iterations']
+        users = dict((user.pk, user) for user in User.objects.all())
+        animals = dict((animal.pk, animal) for animal in Animal.objects.all())
+        object_perms = sorted(cerberus.get_object_perms(Animal))
+        factory = RequestFactory()
+
+        def pick(cold=False):
+            user = users[self.random.choice(self.user_pks)]
+            if cold and hasattr(user, '_cerberus_perm_cache'):
+                del user._cerberus_perm_cache
+            return (user, animals[self.random.choice(self.animal_pks)],
+                self.random.choice(object_perms))
+
+        def pick_warm():
+            # checked once before the measured call fills the user's cache
+            (user, animal, perm) = pick()
+            cerberus.has_perm(user, perm, animal)
+            return (user, animal, perm)
+
+        def view_request():
+            pk = self.random.choice(self.animal_pks)
+            return (factory.get('/permissions/view/animal/%s/' % pk), pk)
+
+        return [
+            ('has_perm cold', self.measure(iterations, lambda: pick(cold=True),
+                lambda user, animal, perm: cerberus.has_perm(user, perm, animal))),
+            ('has_perm warm', self.measure(iterations, pick_warm,
+                lambda user, animal, perm: cerberus.has_perm(user, perm, animal))),
+            ('get_perms', self.measure(iterations, pick,
+                lambda user, animal, perm: user.get_perms(animal))),
+            ('objects_with_perm', self.measure(iterations, lambda: pick(cold=True),
+                lambda user, animal, perm: list(cerberus.objects_with_perm(
+                    user, perm, Animal.objects.all())))),
+            ('permissions_view', self.measure(max(1, iterations / 10), view_request,
+                lambda request, pk: permissions_view(request, 'animal', str(pk)))),
+        ]
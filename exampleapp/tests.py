@@ -5,7 +5,11 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from StringIO import StringIO
+
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import simplejson
 
 
 class SimpleTest(TestCase):
@@ -14,3 +18,21 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class BenchmarkCommandTest(TestCase):
+    """
+    Smoke test of cerberus_benchmark, which relies on cerberus internals.
+    """
+    def test_json_output(self):
+        output = StringIO()
+        call_command('cerberus_benchmark', users=3, groups=2, objects=3, iterations=2,
+            json=True, create_db=False, stdout=output)
+        results = simplejson.loads(output.getvalue())
+        self.assertEqual(set(['has_perm cold', 'has_perm warm', 'get_perms',
+            'objects_with_perm', 'permissions_view']), set(results))
+        for result in results.values():
+            self.assertEqual(set(['mean_ms', 'p95_ms', 'queries']), set(result))
+        # two timings: the p95 is the slower one
+        self.assertTrue(results['has_perm cold']['p95_ms'] >= results['has_perm cold']['mean_ms'])
+        self.assertEqual(0, results['has_perm warm']['queries'])